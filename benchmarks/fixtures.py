@@ -0,0 +1,231 @@
+"""
+Synthetic raw data for the recipe benchmarks.
+
+Each writer creates, inside a raw data folder, the files a recipe reads from
+its (downloaded and extracted) raw data, in the same format as the original
+source. The amount of data is proportional to ``scale`` (``1`` takes a few
+seconds to parse per recipe) and the content only depends on ``seed``.
+"""
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+
+FixtureWriter = Callable[[Path, float, np.random.Generator], None]
+
+
+def _count(base: int, scale: float) -> int:
+    return max(1, int(base * scale))
+
+
+def _write_lines(path: Path, lines: List[str], newline: str = "\n"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8", newline="") as raw_file:
+        raw_file.write(newline.join(lines) + newline)
+
+
+def _random_walk(rng: np.random.Generator, n_points: int, start, step) -> np.ndarray:
+    steps = rng.normal(scale=step, size=(n_points, len(start)))
+    return np.asarray(start) + np.cumsum(steps, axis=0)
+
+
+def _time_steps(
+    rng: np.random.Generator, start: datetime, n_points: int, choices: List[int]
+) -> List[datetime]:
+    seconds = np.cumsum(rng.choice(choices, size=n_points))
+    return [start + timedelta(seconds=int(sec)) for sec in seconds]
+
+
+def write_geolife(raw_dir: Path, scale: float, rng: np.random.Generator):
+    """GeoLife 1.3 tree: a folder per user with PLT files and labels."""
+    data_dir = raw_dir / "Geolife Trajectories 1.3" / "Data"
+    modes = ["walk", "bus", "car", "bike", "subway", "train", "taxi"]
+    plt_header = [
+        "Geolife trajectory",
+        "WGS 84",
+        "Altitude is in Feet",
+        "Reserved 3",
+        "0,2,255,My Track,0,0,2,8421376",
+        "0",
+    ]
+    for usr in range(_count(20, scale)):
+        usr_dir = data_dir / f"{usr:03d}"
+        time = datetime(2008, 4, 1) + timedelta(days=usr)
+        label_lines = ["Start Time\tEnd Time\tTransportation Mode"]
+        for _ in range(10):
+            n_points = int(rng.integers(100, 1000))
+            times = _time_steps(rng, time, n_points, [1, 2, 5])
+            points = _random_walk(rng, n_points, (39.9, 116.3), 1e-4)
+            lines = plt_header + [
+                f"{lat:.6f},{lon:.6f},0,{int(rng.integers(0, 500))},39744.0,"
+                f"{ts:%Y-%m-%d},{ts:%H:%M:%S}"
+                for (lat, lon), ts in zip(points, times)
+            ]
+            _write_lines(usr_dir / "Trajectory" / f"{time:%Y%m%d%H%M%S}.plt", lines)
+
+            # A few labels per file
+            bounds = np.sort(rng.choice(n_points, size=6, replace=False))
+            for start, end in zip(bounds[::2], bounds[1::2]):
+                label_lines.append(
+                    f"{times[start]:%Y/%m/%d %H:%M:%S}\t"
+                    f"{times[end]:%Y/%m/%d %H:%M:%S}\t{rng.choice(modes)}"
+                )
+            time = times[-1] + timedelta(hours=int(rng.integers(1, 30)))
+        _write_lines(usr_dir / "labels.txt", label_lines)
+
+
+def write_hurdat2(raw_dir: Path, scale: float, rng: np.random.Generator):
+    """HURDAT2 text file: a header line per hurricane followed by its fixes."""
+    lines = []
+    for hur in range(_count(2000, scale)):
+        n_points = int(rng.integers(3, 60))
+        lines.append(
+            f"AL{hur % 100:02d}{1851 + hur % 170},{'UNNAMED':>19},{n_points:>6},"
+        )
+        start = datetime(1851 + hur % 170, int(rng.integers(6, 11)), 1)
+        times = _time_steps(rng, start, n_points, [6 * 3600])
+        points = _random_walk(rng, n_points, (25, 70), 0.5)
+        for (lat, lon), ts in zip(points, times):
+            hemisphere = "N" if lat >= 0 else "S"
+            lines.append(
+                f"{ts:%Y%m%d}, {ts:%H%M},  , HU, {abs(lat):4.1f}{hemisphere},"
+                f" {abs(lon):5.1f}W, {int(rng.integers(20, 160)):3d}, -999"
+            )
+    # The last hurricane is only closed by a following header
+    lines.append(f"AL99{2021},{'UNNAMED':>19},{0:>6},")
+    _write_lines(raw_dir / "hurdat2-1851-2021-100522.txt", lines)
+
+
+def write_cma_bst(raw_dir: Path, scale: float, rng: np.random.Generator):
+    """CMA best track: a file per year, a header line per cyclone."""
+    for year in range(1949, 1949 + _count(10, scale)):
+        lines = []
+        for cyc in range(40):
+            n_points = int(rng.integers(3, 60))
+            lines.append(
+                f"66666 0000 {n_points:>3} {cyc:04d} {cyc:04d} 0 6 NAME 20140411"
+            )
+            start = datetime(year, int(rng.integers(5, 11)), 1)
+            times = _time_steps(rng, start, n_points, [6 * 3600])
+            points = _random_walk(rng, n_points, (200, 1300), 5)
+            for (lat, lon), ts in zip(points, times):
+                lines.append(
+                    f"{ts:%Y%m%d%H} {int(rng.integers(0, 7))} {int(lat):3d} "
+                    f"{int(lon):4d} {int(rng.integers(900, 1010)):4d} "
+                    f"{int(rng.integers(10, 70)):3d}"
+                )
+        lines.append("66666 0000   0 0000 0000 0 6 END 20140411")
+        _write_lines(raw_dir / f"CH{year}BST.txt", lines)
+
+
+def write_traffic(raw_dir: Path, scale: float, rng: np.random.Generator):
+    """Zen traffic data csv: the (10 Hz) points of each car, consecutive."""
+    lines = []
+    for car in range(1, _count(2000, scale) + 1):
+        n_points = int(rng.integers(50, 500))
+        start_ms = int(rng.integers(7, 9)) * 3600_000
+        ms = start_ms + 100 * np.arange(n_points)
+        points = _random_walk(rng, n_points, (0, 0), 1)
+        car_type = int(rng.integers(1, 3))
+        for time_ms, (x, y) in zip(ms, points):
+            secs, msecs = divmod(int(time_ms), 1000)
+            hours, rest = divmod(secs, 3600)
+            mins, secs = divmod(rest, 60)
+            lines.append(
+                f"{car},{hours:02d}{mins:02d}{secs:02d}{msecs:03d},{car_type},1,0,"
+                f"{x:.3f},{y:.3f},1"
+            )
+    _write_lines(raw_dir / "TRAJECTORY_PUB_SMP.csv", lines)
+
+
+def write_animals(raw_dir: Path, scale: float, rng: np.random.Generator):
+    """Starkey telemetry: one row per fix, animals and times interleaved."""
+    rows = []
+    for animal in range(_count(200, scale)):
+        n_points = int(rng.integers(500, 3000))
+        species = rng.choice(["E", "D", "C"])
+        start = datetime(1993, 4, 1) + timedelta(days=int(rng.integers(0, 300)))
+        times = _time_steps(rng, start, n_points, [0, 600, 1800, 3600])
+        points = _random_walk(rng, n_points, (380000, 5010000), 30)
+        for ts, (utm_e, utm_n) in zip(times, points):
+            rows.append(
+                f"{int(rng.integers(0, 10**6))},{int(utm_e)},{int(utm_n)},"
+                f"{ts:%Y%m%d},{ts.hour}:{ts:%M:%S},{animal:03d}{species}R,{species}"
+            )
+    order = rng.permutation(len(rows))
+    lines = ["StarkeyTime, UTME, UTMN, LocDate, LocTime, Id, Species"]
+    lines += [rows[i] for i in order]
+    _write_lines(raw_dir / "Starkey_OR_Main_Telemetry_1993-1996_Data.txt", lines)
+
+
+def write_uci_gotrack(raw_dir: Path, scale: float, rng: np.random.Generator):
+    """Go!Track csv files: tracks metadata and points."""
+    n_tracks = _count(160, scale)
+    tracks_lines = [
+        "id,id_android,speed,time,distance,rating,rating_bus,rating_weather,"
+        "car_or_bus,linha"
+    ]
+    tracks_lines += [
+        f"{track},0,10.0,0.5,5.0,3,0,0,{int(rng.integers(1, 3))},"
+        for track in range(1, n_tracks + 1)
+    ]
+    points_lines = ["id,latitude,longitude,track_id,time"]
+    point_id = 0
+    for track in range(1, n_tracks + 1):
+        n_points = int(rng.integers(10, 1000))
+        start = datetime(2014, 9, 1) + timedelta(days=track)
+        times = _time_steps(rng, start, n_points, [0, 1, 2, 5, 10])
+        points = _random_walk(rng, n_points, (-10.9, -37.0), 1e-4)
+        for (lat, lon), ts in zip(points, times):
+            point_id += 1
+            points_lines.append(
+                f"{point_id},{lat:.7f},{lon:.7f},{track},{ts:%Y-%m-%d %H:%M:%S}"
+            )
+    _write_lines(raw_dir / "GPS Trajectory" / "go_track_tracks.csv", tracks_lines)
+    _write_lines(raw_dir / "GPS Trajectory" / "go_track_trackspoints.csv", points_lines)
+
+
+def write_uci_pen_digits(raw_dir: Path, scale: float, rng: np.random.Generator):
+    """Pen digits train and test files: 8 resampled points and the digit."""
+    for file_name, base in (("pendigits.tra", 7494), ("pendigits.tes", 3498)):
+        n_rows = _count(base, scale)
+        coords = rng.integers(0, 101, size=(n_rows, 16))
+        digits = rng.integers(0, 10, size=n_rows)
+        lines = [
+            ",".join(f"{val:>3d}" for val in row) + f",{digit:>2d}"
+            for row, digit in zip(coords, digits)
+        ]
+        _write_lines(raw_dir / file_name, lines, newline="\r\n")
+
+
+def write_uci_movement_libras(raw_dir: Path, scale: float, rng: np.random.Generator):
+    """Libras movement file: 45 (x, y) points and the movement class."""
+    n_rows = _count(360, scale)
+    coords = rng.uniform(0, 1, size=(n_rows, 90))
+    classes = rng.integers(1, 16, size=n_rows)
+    lines = [
+        ",".join(f"{val:.6f}" for val in row) + f",{cls}"
+        for row, cls in zip(coords, classes)
+    ]
+    _write_lines(raw_dir / "movement_libras.data", lines)
+
+
+# Recipe module name -> fixture writer
+FIXTURES: Dict[str, FixtureWriter] = {
+    "animals": write_animals,
+    "cma_bst": write_cma_bst,
+    "geolife": write_geolife,
+    "hurdat2": write_hurdat2,
+    "traffic": write_traffic,
+    "uci_gotrack": write_uci_gotrack,
+    "uci_movement_libras": write_uci_movement_libras,
+    "uci_pen_digits": write_uci_pen_digits,
+}
+
+
+def write_fixture(recipe: str, raw_dir: Path, scale: float = 1.0, seed: int = 0):
+    """Writes the synthetic raw data of a recipe into ``raw_dir``."""
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    FIXTURES[recipe](raw_dir, scale, np.random.default_rng(seed))
@@ -0,0 +1,305 @@
+"""
+Offline benchmarks of the recipe parsers.
+
+Synthetic raw data (see ``benchmarks/fixtures.py``) is written for each
+recipe and then, in a fresh process per recipe, the following stages are
+timed:
+
+- ``parse``: the recipe's ``_yupify`` (or ``yupify``) function, including the
+  creation of the trajectories
+- ``serialize``: writing the yupi json data as ``build.py`` does, but without
+  compression (``store`` codec)
+- ``write``: the output step of ``build.py`` itself (``build._build_recipe``):
+  the json data compressed with the build codec (``--codec``, see
+  ``utils/compression.py``) and the trajectory summary. Compression time is
+  about the difference with ``serialize``
+
+Each stage records its wall time, points per second and the peak RSS of the
+process up to the end of the stage. Results are compared against a stored
+baseline (``benchmarks/baseline.json`` by default).
+
+Run it from the repository root::
+
+    python -m benchmarks.run [recipes] [--scale 0.5] [--save-baseline]
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import logging
+import multiprocessing
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None  # type: ignore
+
+from benchmarks.fixtures import FIXTURES, write_fixture
+from utils.compression import CODECS, DEFAULT_CODEC, open_output, parse_codec
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+DEFAULT_BASELINE = BENCHMARKS_DIR / "baseline.json"
+DEFAULT_TOLERANCE = 0.2
+
+STAGES = ("parse", "serialize", "write")
+
+StageResult = Dict[str, Optional[float]]
+
+
+def _peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def _iter_pairs(parsed: Any) -> Iterator[Tuple[Any, Any]]:
+    if isinstance(parsed, tuple):
+        return zip(*parsed)
+    return iter(parsed)
+
+
+def _stage_result(wall: float, n_points: int) -> StageResult:
+    return {
+        "wall_s": wall,
+        "points": n_points,
+        "points_per_s": n_points / wall if wall > 0 else None,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _bench_recipe(
+    recipe: str, raw_dir: Path, work_dir: Path, codec: str
+) -> Dict[str, Any]:
+    """Runs the benchmark stages of a recipe (in a worker process)."""
+    # pylint: disable=import-outside-toplevel
+    import build
+
+    logging.disable(logging.INFO)
+    module = importlib.import_module(f"recipes.{recipe}")
+    yupify = getattr(module, "_yupify", None) or getattr(module, "yupify")
+
+    results: Dict[str, StageResult] = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        pairs = list(_iter_pairs(yupify(raw_dir)))
+        wall = time.perf_counter() - start
+    n_points = sum(len(traj) for traj, _ in pairs)
+    results["parse"] = _stage_result(wall, n_points)
+
+    pairs = list(build._iter_recipe_data(pairs))
+    store = parse_codec("store")
+    start = time.perf_counter()
+    with open_output(
+        work_dir / f"{recipe}{store.extension}", f"{recipe}.json", store
+    ) as data_file:
+        build._write_yupi_data(data_file, module.VERSION, pairs)
+    results["serialize"] = _stage_result(time.perf_counter() - start, n_points)
+
+    options = build.BuildOptions(codec=codec)
+    start = time.perf_counter()
+    build._build_recipe(work_dir, recipe, module.VERSION, lambda: pairs, options)
+    results["write"] = _stage_result(time.perf_counter() - start, n_points)
+
+    return {"trajs": len(pairs), "points": n_points, "stages": results}
+
+
+def run_benchmarks(
+    recipes: List[str],
+    data_dir: Path,
+    scale: float,
+    seed: int,
+    codec: str = DEFAULT_CODEC,
+) -> Dict[str, Any]:
+    """Writes the fixtures (if missing) and benchmarks each recipe."""
+    results: Dict[str, Any] = {}
+    for recipe in recipes:
+        raw_dir = data_dir / f"scale-{scale:g}-seed-{seed}" / recipe
+        if not raw_dir.exists():
+            logging.info("Writing synthetic raw data for %s", recipe)
+            write_fixture(recipe, raw_dir, scale, seed)
+
+        logging.info("Benchmarking %s", recipe)
+        with tempfile.TemporaryDirectory() as work_dir:
+            # A fresh process per recipe, so peak RSS is not shared
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                future = executor.submit(
+                    _bench_recipe, recipe, raw_dir, Path(work_dir), codec
+                )
+                results[recipe] = future.result()
+    return {"scale": scale, "seed": seed, "codec": codec, "results": results}
+
+
+def compare(
+    current: Dict[str, Any], baseline: Optional[Dict[str, Any]], tolerance: float
+) -> List[str]:
+    """
+    Prints the results (and their ratio to the baseline). Returns the stages
+    that are slower than the baseline by more than ``tolerance``.
+    """
+    if baseline is not None and baseline.get("scale") != current["scale"]:
+        logging.warning(
+            "Baseline scale (%s) differs from the current one (%s), not comparing",
+            baseline.get("scale"),
+            current["scale"],
+        )
+        baseline = None
+    if (
+        baseline is not None
+        and baseline.get("codec", DEFAULT_CODEC) != current["codec"]
+    ):
+        logging.warning(
+            "Baseline codec (%s) differs from the current one (%s), "
+            "not comparing the write stage",
+            baseline.get("codec", DEFAULT_CODEC),
+            current["codec"],
+        )
+        skip_stages = {"write"}
+    else:
+        skip_stages = set()
+
+    regressions = []
+    print(
+        f"{'recipe':<22}{'stage':<11}{'wall [s]':>10}{'points/s':>14}"
+        f"{'peak RSS [MB]':>15}{'vs baseline':>13}"
+    )
+    for recipe, recipe_res in current["results"].items():
+        base_stages = {}
+        if baseline is not None:
+            base_stages = baseline["results"].get(recipe, {}).get("stages", {})
+        for stage in STAGES:
+            res = recipe_res["stages"][stage]
+            ratio = ""
+            base_wall = base_stages.get(stage, {}).get("wall_s")
+            if base_wall and stage not in skip_stages:
+                ratio_val = res["wall_s"] / base_wall
+                ratio = f"x{ratio_val:.2f}"
+                if ratio_val > 1 + tolerance:
+                    ratio += " !"
+                    regressions.append(f"{recipe}:{stage}")
+            points_s = res["points_per_s"] or 0
+            rss = res["peak_rss_mb"]
+            rss_str = "-" if rss is None else f"{rss:.1f}"
+            print(
+                f"{recipe:<22}{stage:<11}{res['wall_s']:>10.3f}{points_s:>14,.0f}"
+                f"{rss_str:>15}{ratio:>13}"
+            )
+    return regressions
+
+
+def _save_results(path: Path, results: Dict[str, Any]):
+    with open(path, "w", encoding="utf-8") as res_file:
+        json.dump(results, res_file, indent=4)
+    logging.info("Results saved to %s", path)
+
+
+def _parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the recipe parsers")
+    parser.add_argument(
+        "recipes",
+        nargs="?",
+        default=None,
+        help="Recipes to benchmark (comma separated, default: all with fixtures)",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Size of the synthetic raw data (default: 1)",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Synthetic data seed")
+    parser.add_argument(
+        "--codec",
+        default=DEFAULT_CODEC,
+        help=f"Codec of the write stage, as name[:level] "
+        f"({', '.join(CODECS)}; default: {DEFAULT_CODEC})",
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=None,
+        help="Folder to keep the synthetic raw data between runs "
+        "(default: a temporary folder)",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=DEFAULT_BASELINE,
+        help=f"Baseline results file (default: {DEFAULT_BASELINE.name})",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store the results as the new baseline",
+    )
+    parser.add_argument(
+        "--output", type=Path, default=None, help="Also write the results here"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="Allowed slowdown over the baseline (default: 0.2, i.e. 20%%)",
+    )
+    parser.add_argument(
+        "--fail-on-regression",
+        action="store_true",
+        help="Exit with an error if any stage is slower than the baseline",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = _parse_args(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    recipes = sorted(FIXTURES)
+    if args.recipes:
+        recipes = [recipe for recipe in args.recipes.split(",") if recipe]
+        unknown = sorted(set(recipes) - set(FIXTURES))
+        if unknown:
+            sys.exit(f"No synthetic raw data for: {', '.join(unknown)}")
+
+    try:
+        codec = str(parse_codec(args.codec))
+    except ValueError as err:
+        sys.exit(str(err))
+
+    with contextlib.ExitStack() as stack:
+        data_dir = args.data_dir
+        if data_dir is None:
+            data_dir = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+        current = run_benchmarks(recipes, data_dir, args.scale, args.seed, codec)
+
+    baseline = None
+    if args.baseline.exists():
+        with open(args.baseline, "r", encoding="utf-8") as base_file:
+            baseline = json.load(base_file)
+    regressions = compare(current, baseline, args.tolerance)
+
+    if args.output is not None:
+        _save_results(args.output, current)
+    if args.save_baseline:
+        # Recipes that were not benchmarked keep their baseline
+        if baseline is not None and baseline.get("scale") == current["scale"]:
+            current["results"] = {**baseline["results"], **current["results"]}
+        _save_results(args.baseline, current)
+
+    if regressions:
+        logging.warning("Slower than baseline: %s", ", ".join(regressions))
+        if args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,91 +1,362 @@
+import argparse
+import contextlib
+import datetime
+import inspect
 import json
 import logging
 import sys
-import zipfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import Callable, List
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
 from yupi import Trajectory
 from yupi.core import JSONSerializer
 
 import config
+from utils import instrument
+from utils.columnar import COLUMNAR_EXTENSION, ColumnarWriter
+from utils.compression import (
+    CODECS,
+    DEFAULT_CODEC,
+    check_codec,
+    open_output,
+    parse_codec,
+)
+from utils.label_partition import LabelPartitionWriter, labels_dir
+from utils.manifest import (
+    MANIFEST_FILE_NAME,
+    code_fingerprint,
+    inputs_changed,
+    inputs_fingerprint,
+    load_manifest,
+    outputs_changed,
+    outputs_fingerprint,
+    save_manifest,
+)
+from utils.shards import (
+    SHARD_INDEX_FILE_NAME,
+    ShardWriter,
+    load_shard_index,
+    shards_dir,
+)
+from utils.spatial import SPATIAL_INDEX_EXTENSION, SpatialIndexWriter
+from utils.summary import SUMMARY_EXTENSION, SummaryWriter
 from utils.utils import _get_path
 
 RECIPIES_DIR = Path("./recipes")
 
-
-def _read_cache_version(name: str) -> int:
-    ds_dir = _get_path(config.DS_DIR, name)
-    yupi_data_json = ds_dir / "yupi_data.json"
-
-    if not yupi_data_json.exists():
-        return -1
-
-    yupi_data = _load_yupi_data(yupi_data_json)
-    return yupi_data.get("version", -1)
-
-
-def _cache_up_to_date(name: str, version: int) -> bool:
+# Code every recipe build depends on
+SHARED_CODE = [
+    Path(__file__).resolve(),
+    Path(config.__file__).resolve(),
+    *sorted((Path(__file__).resolve().parent / "utils").glob("*.py")),
+]
+
+STATUS_BUILT = "succeeded"
+STATUS_FAILED = "failed"
+STATUS_SKIPPED = "skipped"
+
+BUILD_REPORT_FILE_NAME = "build_report.json"
+
+
+class BuildOptions(NamedTuple):
+    """Options shared by every recipe build."""
+
+    binary: bool = False
+    """Also write the columnar binary version of the dataset"""
+
+    trace_memory: bool = False
+    """Probe the peak memory of each build stage (slows the build down)"""
+
+    codec: str = DEFAULT_CODEC
+    """Compression codec of the json output (see utils/compression.py)"""
+
+    shards: int = 0
+    """Split the json output in this many shards (see utils/shards.py), or
+    write a single file if 0"""
+
+    spatial_index: bool = False
+    """Also write a spatial index of the trajectories (see utils/spatial.py)"""
+
+    by_label: bool = False
+    """Also write the json output partitioned by label (see
+    utils/label_partition.py)"""
+
+
+def _manifest_path(name: str) -> Path:
+    return _get_path(config.DS_DIR, name) / MANIFEST_FILE_NAME
+
+
+def _manifest_key(output_dir: Path) -> str:
+    # Each build folder has its own entry in the manifest of a dataset
+    return str(output_dir.resolve())
+
+
+def _build_fingerprint(
+    version: int, build_func: Callable, options: BuildOptions
+) -> Dict[str, Any]:
+    recipe_path = Path(inspect.getfile(build_func)).resolve()
+    return {
+        "version": version,
+        "recipe": code_fingerprint([recipe_path]),
+        "shared": code_fingerprint(SHARED_CODE),
+        "codec": str(parse_codec(options.codec)),
+        "shards": options.shards,
+        "binary": options.binary,
+        "spatial_index": options.spatial_index,
+        "by_label": options.by_label,
+    }
+
+
+def _output_paths(output_dir: Path, name: str, options: BuildOptions) -> List[Path]:
+    if options.shards:
+        outputs = [shards_dir(output_dir, name) / SHARD_INDEX_FILE_NAME]
+    else:
+        outputs = [output_dir / f"{name}{parse_codec(options.codec).extension}"]
+    outputs.append(output_dir / f"{name}{SUMMARY_EXTENSION}")
+    if options.spatial_index:
+        outputs.append(output_dir / f"{name}{SPATIAL_INDEX_EXTENSION}")
+    if options.by_label:
+        outputs.append(labels_dir(output_dir, name) / SHARD_INDEX_FILE_NAME)
+    if options.binary:
+        outputs.append(output_dir / f"{name}{COLUMNAR_EXTENSION}")
+    return outputs
+
+
+def _output_files(output_dir: Path, name: str, options: BuildOptions) -> List[Path]:
+    """Every file written by a build, including the files listed in indexes."""
+    files = _output_paths(output_dir, name, options)
+    if options.shards:
+        path = shards_dir(output_dir, name)
+        files += [path / entry["file"] for entry in load_shard_index(path)["shards"]]
+    if options.by_label:
+        path = labels_dir(output_dir, name)
+        files += [path / entry["file"] for entry in load_shard_index(path)["labels"]]
+    return files
+
+
+def _cache_up_to_date(
+    output_dir: Path,
+    name: str,
+    version: int,
+    build_func: Callable,
+    options: BuildOptions,
+) -> bool:
     # Check if rebuild is required
-    cache_version = _read_cache_version(name)
-    rebuild = version > cache_version
-    return not rebuild
-
-
-def _load_yupi_data(yupi_data_json: Path):
-    with open(yupi_data_json, "r", encoding="utf-8") as md_file:
-        return json.load(md_file)
-
-
-def _save_yupi_data(yupi_data: dict, path: Path):
-    with open(path, "w", encoding="utf-8") as md_file:
-        json.dump(yupi_data, md_file, ensure_ascii=False, indent=4)
-
-
-def _update_labels(trajs: List[Trajectory]):
-    for i, traj in enumerate(trajs):
+    manifest = load_manifest(_manifest_path(name)) or {}
+    build = manifest.get("builds", {}).get(_manifest_key(output_dir))
+    if build is None:
+        return False
+
+    fingerprint = _build_fingerprint(version, build_func, options)
+    if any(build.get(key) != val for key, val in fingerprint.items()):
+        return False
+
+    # Outputs must be the ones written by the last build
+    outputs = build.get("outputs", {})
+    expected = _output_paths(output_dir, name, options)
+    if any(path.relative_to(output_dir).as_posix() not in outputs for path in expected):
+        return False
+    if outputs_changed(output_dir, outputs):
+        return False
+
+    raw_dir = _get_path(config.DS_RAW_DIR, name)
+    return not inputs_changed(raw_dir, build.get("inputs", {}))
+
+
+def _save_build_manifest(
+    output_dir: Path,
+    name: str,
+    version: int,
+    build_func: Callable,
+    options: BuildOptions,
+):
+    manifest_path = _manifest_path(name)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    builds = (load_manifest(manifest_path) or {}).get("builds", {})
+    key = _manifest_key(output_dir)
+    raw_dir = _get_path(config.DS_RAW_DIR, name)
+
+    build = _build_fingerprint(version, build_func, options)
+    build["inputs"] = inputs_fingerprint(raw_dir, builds.get(key, {}).get("inputs"))
+    build["outputs"] = outputs_fingerprint(
+        output_dir, _output_files(output_dir, name, options)
+    )
+    builds[key] = build
+    save_manifest(manifest_path, {"builds": builds})
+
+
+_JSON_SEPARATORS = (",", ":")
+
+TrajLabel = Tuple[Trajectory, Any]
+
+
+def _write_yupi_data(yupi_file: IO[str], version: int, pairs: Iterable[TrajLabel]):
+    """
+    Writes the yupi data json one trajectory at a time, so only a single
+    serialized trajectory is kept in memory.
+    """
+    # json.dumps (unlike json.dump) uses the C encoder
+    encode = json.JSONEncoder(ensure_ascii=False, separators=_JSON_SEPARATORS).encode
+
+    labels = []
+    yupi_file.write(f'{{"version":{encode(version)},"trajs":[')
+    for i, (traj, label) in enumerate(pairs):
+        if i:
+            yupi_file.write(",")
+        with instrument.stage("to_json", memory=False):
+            traj_json = JSONSerializer.to_json(traj)
+        yupi_file.write(encode(traj_json))
+        labels.append(label)
+    yupi_file.write(f'],"labels":{encode(labels)}}}')
+
+
+def _iter_recipe_data(build_result: Any) -> Iterator[TrajLabel]:
+    """
+    Iterates over the (trajectory, label) pairs of a recipe build, checking
+    them and assigning the trajectory ids.
+
+    ``build_result`` is either a ``(trajs, labels)`` tuple of lists or an
+    iterable of ``(traj, label)`` pairs (e.g. when ``build`` is a generator).
+    """
+    if isinstance(build_result, tuple):
+        trajs, labels = build_result
+        if len(trajs) != len(labels):
+            raise ValueError(
+                f"Number of trajectories and labels must be equal. "
+                f"Got {len(trajs)} trajectories and {len(labels)} labels."
+            )
+        if not all(len(traj) > 1 for traj in trajs):
+            raise ValueError("All trajectories must have at least 2 points.")
+        build_result = zip(trajs, labels)
+    else:
+        # Generator recipes do their work while the pairs are consumed
+        build_result = instrument.timed_iter(build_result, "build")
+
+    for i, (traj, label) in enumerate(build_result):
+        if len(traj) <= 1:
+            raise ValueError(
+                f"All trajectories must have at least 2 points. "
+                f"Trajectory {i} has {len(traj)}."
+            )
         traj.traj_id = str(i)
-    return trajs
-
-
-def _build_recipe(output_dir: Path, name: str, version: int, build_func: Callable):
-    trajs, labels = build_func()
-    if len(trajs) != len(labels):
-        raise ValueError(
-            f"Number of trajectories and labels must be equal. "
-            f"Got {len(trajs)} trajectories and {len(labels)} labels."
-        )
-
-    if not all(len(traj) > 1 for traj in trajs):
-        raise ValueError("All trajectories must have at least 2 points.")
-
-    trajs = _update_labels(trajs)
-
-    ds_dir = _get_path(config.DS_DIR, name)
-    ds_dir.mkdir(parents=True, exist_ok=True)
-    json_trajs = [JSONSerializer.to_json(traj) for traj in trajs]
-    yupi_data = {"version": version, "trajs": json_trajs, "labels": labels}
-
-    logging.info("Saving yupify trajectories for %s dataset", name)
-    data_path = ds_dir / "yupi_data.json"
-    _save_yupi_data(yupi_data, data_path)
-
-    # Compress to output dir
-    output_zip = output_dir / f"{name}.zip"
-    output_zip.parent.mkdir(parents=True, exist_ok=True)
-    with zipfile.ZipFile(output_zip, "w", zipfile.ZIP_DEFLATED) as zip_ref:
-        zip_ref.write(filename=data_path, arcname=f"{name}.json")
-
-
-def build_recipe(output_dir: Path, name: str, version: int, build_func: Callable):
-    if _cache_up_to_date(name, version):
+        instrument.count_traj(len(traj))
+        yield traj, label
+
+
+def _tee(
+    pairs: Iterable[TrajLabel], add: Callable[[Trajectory, Any], None], stage: str
+) -> Iterator[TrajLabel]:
+    """Passes each pair to ``add`` (timed as ``stage``) as it is consumed."""
+    for traj, label in pairs:
+        with instrument.stage(stage, memory=False):
+            add(traj, label)
+        yield traj, label
+
+
+def _finish_outputs(finishers: List[Tuple[str, Callable[[], Any]]]):
+    for stage, finish in finishers:
+        with instrument.stage(stage):
+            finish()
+
+
+def _build_recipe(
+    output_dir: Path,
+    name: str,
+    version: int,
+    build_func: Callable,
+    options: BuildOptions = BuildOptions(),
+):
+    codec = parse_codec(options.codec)
+    output_path = output_dir / f"{name}{codec.extension}"
+
+    with contextlib.ExitStack() as stack:
+        with instrument.stage("build"):
+            build_result = build_func()
+
+        # Trajectories are serialized as the recipe produces them
+        pairs = _iter_recipe_data(build_result)
+        summary = SummaryWriter(output_dir / f"{name}{SUMMARY_EXTENSION}", version)
+        pairs = _tee(pairs, summary.add, "summary")
+        if options.spatial_index:
+            spatial_index = SpatialIndexWriter(
+                output_dir / f"{name}{SPATIAL_INDEX_EXTENSION}"
+            )
+            pairs = _tee(pairs, spatial_index.add, "spatial_index")
+        if options.binary:
+            logging.info("Saving columnar binary version of %s dataset", name)
+            writer = stack.enter_context(
+                ColumnarWriter(output_dir / f"{name}{COLUMNAR_EXTENSION}", version)
+            )
+            pairs = _tee(pairs, writer.add, "columnar")
+        if options.by_label:
+            label_writer = stack.enter_context(
+                LabelPartitionWriter(output_dir, name, version, codec)
+            )
+            pairs = _tee(pairs, label_writer.add, "by_label")
+
+        # The other outputs are written before the main one is committed, so a
+        # build that fails on any of them keeps the previous main output
+        finishers: List[Tuple[str, Callable[[], Any]]] = []
+        if options.binary:
+            finishers.append(("columnar_write", writer.close))
+        finishers.append(("summary_write", summary.close))
+        if options.spatial_index:
+            finishers.append(("spatial_index_write", spatial_index.close))
+        if options.by_label:
+            finishers.append(("by_label_write", label_writer.close))
+
+        logging.info("Saving yupify trajectories for %s dataset (%s)", name, codec)
+        if options.shards:
+            shard_writer = stack.enter_context(
+                ShardWriter(output_dir, name, version, options.shards, codec)
+            )
+            with instrument.stage("save_yupi_data"):
+                for traj, label in pairs:
+                    shard_writer.add(traj, label)
+            _finish_outputs(finishers)
+            with instrument.stage("write_shards"):
+                shard_writer.close()
+        else:
+            # The json is compressed into the output file as it is written
+            with open_output(output_path, f"{name}.json", codec) as yupi_file:
+                with instrument.stage("save_yupi_data"):
+                    _write_yupi_data(yupi_file, version, pairs)
+                _finish_outputs(finishers)
+
+
+def build_recipe(
+    output_dir: Path,
+    name: str,
+    version: int,
+    build_func: Callable,
+    options: BuildOptions = BuildOptions(),
+) -> bool:
+    """Builds a recipe if needed. Returns whether a build actually happened."""
+    if _cache_up_to_date(output_dir, name, version, build_func, options):
         logging.info("Dataset '%s' is up to date (v%s)", name, version)
-        return
+        return False
 
-    _build_recipe(output_dir, name, version, build_func)
+    _build_recipe(output_dir, name, version, build_func, options)
+    _save_build_manifest(output_dir, name, version, build_func, options)
+    return True
 
 
-def process_recipe(output_dir: Path, recipe_py_path: Path):
+def process_recipe(
+    output_dir: Path, recipe_py_path: Path, options: BuildOptions = BuildOptions()
+) -> bool:
     # import NAME, VERSION and build from .py
     module_name = recipe_py_path.name.replace(".py", "")
 
@@ -97,19 +368,220 @@ def process_recipe(output_dir: Path, recipe_py_path: Path):
     version = recipe.VERSION
     build_func = recipe.build
 
-    build_recipe(output_dir, name, version, build_func)
+    return build_recipe(output_dir, name, version, build_func, options)
 
 
-def main():
-    only_recipies = sys.argv[1].split(",") if len(sys.argv) > 1 else None
-    output_dir = Path("./builds")
-    for dataset_recipe in RECIPIES_DIR.glob("[!_]*.py"):
-        if dataset_recipe.stem not in only_recipies:
-            continue
+def _run_recipe(
+    output_dir: Path, recipe_py_path: Path, options: BuildOptions
+) -> Dict[str, Any]:
+    """Runs a recipe. Returns its status and build report."""
+    with instrument.recipe_report(recipe_py_path.stem, options.trace_memory) as report:
         try:
-            process_recipe(output_dir, dataset_recipe)
+            built = process_recipe(output_dir, recipe_py_path, options)
+            status = STATUS_BUILT if built else STATUS_SKIPPED
         except AttributeError:
-            logging.error("Recipe '%s' has missing fields", str(dataset_recipe))
+            logging.error("Recipe '%s' has missing fields", str(recipe_py_path))
+            status = STATUS_FAILED
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Recipe '%s' failed", str(recipe_py_path))
+            status = STATUS_FAILED
+    return {"status": status, **report.to_dict()}
+
+
+def _run_recipe_isolated(
+    output_dir: Path, recipe_py_path: Path, options: BuildOptions
+) -> Dict[str, Any]:
+    """Runs a recipe in a worker process, logging to its own file."""
+    log_path = output_dir / "logs" / f"{recipe_py_path.stem}.log"
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.setLevel(logging.INFO)
+
+    with open(log_path, "w", encoding="utf-8") as log_file:
+        handler = logging.StreamHandler(log_file)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        root_logger.addHandler(handler)
+        try:
+            # Progress bars are printed to stdout, keep them out of the
+            # console where several recipes would interleave.
+            with contextlib.redirect_stdout(log_file):
+                return _run_recipe(output_dir, recipe_py_path, options)
+        finally:
+            root_logger.removeHandler(handler)
+
+
+def _select_recipes(only_recipies: Optional[List[str]]) -> List[Path]:
+    recipes = sorted(RECIPIES_DIR.glob("[!_]*.py"))
+    if only_recipies is None:
+        return recipes
+    return [recipe for recipe in recipes if recipe.stem in only_recipies]
+
+
+def _log_summary(results: Dict[str, str]):
+    for status in (STATUS_BUILT, STATUS_SKIPPED, STATUS_FAILED):
+        names = sorted(name for name, res in results.items() if res == status)
+        logging.info("%s (%d): %s", status.capitalize(), len(names), ", ".join(names))
+
+
+def _save_build_report(
+    path: Path,
+    reports: Dict[str, Dict[str, Any]],
+    options: BuildOptions,
+    jobs: int,
+    wall_s: float,
+):
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "jobs": jobs,
+        "options": options._asdict(),
+        "wall_s": wall_s,
+        "recipes": {name: reports[name] for name in sorted(reports)},
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=4)
+    logging.info("Build report saved to %s", path)
+
+
+def _codec_arg(value: str) -> str:
+    try:
+        codec = parse_codec(value)
+        check_codec(codec)
+    except (ValueError, ImportError) as err:
+        raise argparse.ArgumentTypeError(str(err)) from err
+    return str(codec)
+
+
+def _jobs_arg(value: str) -> int:
+    jobs = int(value)
+    if jobs < 1:
+        raise argparse.ArgumentTypeError("The number of jobs must be at least 1")
+    return jobs
+
+
+def _shards_arg(value: str) -> int:
+    shards = int(value)
+    if shards < 0:
+        raise argparse.ArgumentTypeError("The number of shards can not be negative")
+    return shards
+
+
+def _parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Build the trajectory datasets")
+    parser.add_argument(
+        "only_recipies",
+        nargs="?",
+        default=None,
+        help="Only recipes to build (comma separated, e.g. 'recipe1,recipe2')",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=_jobs_arg,
+        default=1,
+        help="Number of recipes to build in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="Also write a columnar binary version (.npz) of each dataset",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Record the peak memory of each build stage in the build report "
+        "(slows the build down)",
+    )
+    parser.add_argument(
+        "--codec",
+        type=_codec_arg,
+        default=DEFAULT_CODEC,
+        help=f"Compression of the json output, as name[:level] "
+        f"({', '.join(CODECS)}; default: {DEFAULT_CODEC})",
+    )
+    parser.add_argument(
+        "--spatial-index",
+        action="store_true",
+        help="Also write a spatial index (.rtree.npz) of the trajectories of each "
+        "dataset, to query the ones passing through a region",
+    )
+    parser.add_argument(
+        "--shards",
+        type=_shards_arg,
+        default=0,
+        help="Split the json output of each dataset in this many shards of about "
+        "the same number of points, plus an index (default: 0, a single file)",
+    )
+    parser.add_argument(
+        "--by-label",
+        action="store_true",
+        help="Also write the json output of each dataset partitioned by label, "
+        "one file per label plus an index, to load only some classes",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = _parse_args(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+
+    only_recipies = args.only_recipies.split(",") if args.only_recipies else None
+    output_dir = Path(config.BUILD_PATH)
+    recipes = _select_recipes(only_recipies)
+    options = BuildOptions(
+        binary=args.binary,
+        trace_memory=args.trace_memory,
+        codec=args.codec,
+        shards=args.shards,
+        spatial_index=args.spatial_index,
+        by_label=args.by_label,
+    )
+
+    start = time.perf_counter()
+    reports: Dict[str, Dict[str, Any]] = {}
+    if args.jobs == 1:
+        for dataset_recipe in recipes:
+            reports[dataset_recipe.stem] = _run_recipe(
+                output_dir, dataset_recipe, options
+            )
+    else:
+        logging.info(
+            "Building %d recipes with %d jobs (logs in %s)",
+            len(recipes),
+            args.jobs,
+            output_dir / "logs",
+        )
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = {
+                executor.submit(
+                    _run_recipe_isolated, output_dir, recipe, options
+                ): recipe
+                for recipe in recipes
+            }
+            for future in as_completed(futures):
+                recipe = futures[future]
+                try:
+                    reports[recipe.stem] = future.result()
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception("Worker for '%s' crashed", recipe.stem)
+                    reports[recipe.stem] = {"status": STATUS_FAILED}
+                logging.info("%s: %s", recipe.stem, reports[recipe.stem]["status"])
+
+    _save_build_report(
+        output_dir / BUILD_REPORT_FILE_NAME,
+        reports,
+        options,
+        args.jobs,
+        time.perf_counter() - start,
+    )
+    results = {name: report["status"] for name, report in reports.items()}
+    _log_summary(results)
+    if STATUS_FAILED in results.values():
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 """
 General configurations
 """
+
 import os
 from pathlib import Path
 
@@ -8,6 +9,11 @@ from pathlib import Path
 # Download configs
 # -----------------------------------------------------------------------------
 DOWNLOAD_CHUNCK_SIZE = 4096
+DOWNLOAD_MAX_WORKERS = 4
+DOWNLOAD_TIMEOUT = 60  # seconds without receiving data before giving up
+# What to do when a downloaded file differs from the remote one (or it can not
+# be checked): "overwrite", "keep" or "fail"
+DOWNLOAD_POLICY = os.environ.get("TRAJ_DOWNLOAD_POLICY", "overwrite")
 PROGRESS_BAR_LENGTH = 50
 
 # -----------------------------------------------------------------------------
@@ -15,18 +21,44 @@ PROGRESS_BAR_LENGTH = 50
 # -----------------------------------------------------------------------------
 
 # Dataset structure: (mainly for downloadable datasets)
-#  [build dir]
+#  [build dir] (TRAJ_BUILD_PATH, defaults to ./builds)
 #  └── datasets
-#      └── [dataset_name].zip (compressed json file containing version, trajs and labels)
+#      └── [dataset_name].zip (compressed json file containing version, trajs and labels,
+#                              or [dataset_name].json.zst, see utils/compression.py)
+#      └── [dataset_name].npz (optional columnar binary version, see utils/columnar.py)
+#      └── [dataset_name].summary.npz (per-trajectory summary, see utils/summary.py)
+#      └── [dataset_name].rtree.npz (optional spatial index, see utils/spatial.py)
+#      └── [dataset_name]-shards (optional, instead of the json file, see utils/shards.py)
+#          ├── index.json
+#          └── [dataset_name]-[i]-of-[n].zip
+#      └── [dataset_name]-by-label (optional, see utils/label_partition.py)
+#          ├── index.json
+#          └── [dataset_name]-label-[i].zip
 #
 #  [cache_dir]
 #  └── datasets
 #      └── [dataset_name]
-#          ├── [unzipped dataset files]
-#          └── yupi_data.json
+#          ├── raw_data (downloaded files, archives are read in place, see utils/rawfs.py)
+#          ├── registers (geolife only, parsed registers of each user)
+#          └── build_manifest.json (fingerprint of the last build in each build dir,
+#                                   see utils/manifest.py)
+#  └── decoded (columnar arrays of the loaded datasets, see loader.load_dataset)
+#      ├── [dataset_name]-[artifact hash].npz
+#      └── [dataset_name].json (hash of the last loaded artifact)
 #
 
+BUILD_PATH = os.environ.get("TRAJ_BUILD_PATH", str(Path(__file__).parent / "builds"))
 CACHE_PATH = os.environ.get("TRAJ_CACHE_PATH", str(Path(__file__).parent / ".cache"))
 DS_BASE_DIR = CACHE_PATH + "/datasets"
 DS_DIR = DS_BASE_DIR + "/{0}"
 DS_RAW_DIR = DS_DIR + "/raw_data"
+DECODED_DIR = CACHE_PATH + "/decoded"
+
+# -----------------------------------------------------------------------------
+# Loader configs
+# -----------------------------------------------------------------------------
+# Number of datasets, and memory of their arrays read into memory, kept loaded
+# in a process. Memory-mapped arrays (the default) are not counted, so only
+# loads with mmap=False are bounded by the memory.
+LOADER_CACHE_SIZE = int(os.environ.get("TRAJ_LOADER_CACHE_SIZE", "8"))
+LOADER_CACHE_MB = int(os.environ.get("TRAJ_LOADER_CACHE_MB", "1024"))
@@ -0,0 +1,519 @@
+"""
+Loading of built datasets.
+"""
+
+import itertools
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    overload,
+)
+
+import numpy as np
+from yupi import Trajectory
+
+import config
+from utils.columnar import (
+    COLUMNAR_EXTENSION,
+    ColumnarData,
+    ColumnarWriter,
+    json_traj_arrays,
+    load_columnar,
+)
+from utils.compression import ZIP_EXTENSION, ZSTD_EXTENSION, open_input
+from utils.label_partition import labels_dir
+from utils.manifest import file_sha256, load_manifest, save_manifest
+from utils.shards import (
+    SHARD_INDEX_FILE_NAME,
+    load_shard_index,
+    read_shard,
+    shards_dir,
+)
+from utils.spatial import SPATIAL_INDEX_EXTENSION, SpatialIndex, read_spatial_index
+from utils.summary import SUMMARY_EXTENSION, Summary, read_summary
+
+
+class ColumnarDataset(Sequence):
+    """
+    Sequence of the trajectories of a dataset stored in the columnar layout.
+
+    Trajectories are only created when accessed, from views of the underlying
+    (possibly memory-mapped) arrays.
+    """
+
+    def __init__(self, name: str, data: ColumnarData):
+        self.name = name
+        self.data = data
+
+    @property
+    def version(self) -> int:
+        """Version of the dataset"""
+        return self.data.version
+
+    @property
+    def labels(self) -> np.ndarray:
+        """Label of each trajectory"""
+        return self.data.labels
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of points of each trajectory"""
+        return np.diff(self.data.offsets)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @overload
+    def __getitem__(self, index: int) -> Trajectory: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[Trajectory]: ...
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.data.traj(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Trajectory index {index} out of range")
+        return self.data.traj(index)
+
+    def __repr__(self) -> str:
+        return f"ColumnarDataset(name={self.name!r}, trajs={len(self)})"
+
+
+def load(
+    name: str, mmap: bool = True, build_dir: Optional[Union[str, Path]] = None
+) -> ColumnarDataset:
+    """
+    Loads a dataset from its columnar binary version.
+
+    Parameters
+    ----------
+    name : str
+        Name of the dataset.
+    mmap : bool
+        If True (default), the arrays are memory-mapped, so only the
+        trajectories that are accessed are read from disk.
+    build_dir : Optional[Union[str, Path]]
+        Folder containing the built datasets. Defaults to ``TRAJ_BUILD_PATH``.
+
+    Returns
+    -------
+    ColumnarDataset
+        Sequence of the trajectories of the dataset.
+    """
+    build_dir = Path(config.BUILD_PATH if build_dir is None else build_dir)
+    path = build_dir / f"{name}{COLUMNAR_EXTENSION}"
+    if not path.exists():
+        raise FileNotFoundError(
+            f"{path} not found. Build it with: python build.py {name} --binary"
+        )
+    return ColumnarDataset(name, load_columnar(path, mmap=mmap))
+
+
+def _shards_dir(name: str, build_dir: Optional[Union[str, Path]]) -> Path:
+    build_dir = Path(config.BUILD_PATH if build_dir is None else build_dir)
+    path = shards_dir(build_dir, name)
+    if not (path / SHARD_INDEX_FILE_NAME).exists():
+        raise FileNotFoundError(
+            f"{path / SHARD_INDEX_FILE_NAME} not found. "
+            f"Build it with: python build.py {name} --shards <n>"
+        )
+    return path
+
+
+def shard_index(
+    name: str, build_dir: Optional[Union[str, Path]] = None
+) -> Dict[str, Any]:
+    """
+    Loads the index of a sharded dataset: its shards with their trajectory
+    ranges, number of points and sizes (see ``utils/shards.py``).
+    """
+    return load_shard_index(_shards_dir(name, build_dir))
+
+
+def load_shards(
+    name: str,
+    shards: Optional[Iterable[int]] = None,
+    build_dir: Optional[Union[str, Path]] = None,
+) -> Tuple[List[Trajectory], List[Any]]:
+    """
+    Loads the trajectories and labels of some shards of a sharded dataset.
+
+    Parameters
+    ----------
+    name : str
+        Name of the dataset.
+    shards : Optional[Iterable[int]]
+        Shards to load, all of them by default. For instance, worker ``i`` of
+        ``n`` data-loader workers can load ``range(i, n_shards, n)``.
+    build_dir : Optional[Union[str, Path]]
+        Folder containing the built datasets. Defaults to ``TRAJ_BUILD_PATH``.
+
+    Returns
+    -------
+    Tuple[List[Trajectory], List[Any]]
+        Trajectories (with their dataset-wide ids) and labels of the shards.
+    """
+    path = _shards_dir(name, build_dir)
+    index = load_shard_index(path)
+    if shards is None:
+        shards = range(len(index["shards"]))
+
+    trajs: List[Trajectory] = []
+    labels: List[Any] = []
+    for shard in shards:
+        shard_trajs, shard_labels = read_shard(path / index["shards"][shard]["file"])
+        trajs.extend(shard_trajs)
+        labels.extend(shard_labels)
+    return trajs, labels
+
+
+def _labels_dir(name: str, build_dir: Optional[Union[str, Path]]) -> Path:
+    build_dir = Path(config.BUILD_PATH if build_dir is None else build_dir)
+    path = labels_dir(build_dir, name)
+    if not (path / SHARD_INDEX_FILE_NAME).exists():
+        raise FileNotFoundError(
+            f"{path / SHARD_INDEX_FILE_NAME} not found. "
+            f"Build it with: python build.py {name} --by-label"
+        )
+    return path
+
+
+def label_index(
+    name: str, build_dir: Optional[Union[str, Path]] = None
+) -> Dict[str, Any]:
+    """
+    Loads the index of a label-partitioned dataset: its labels with their
+    files, ranges, number of points and sizes (see
+    ``utils/label_partition.py``).
+    """
+    return load_shard_index(_labels_dir(name, build_dir))
+
+
+def load_labels(
+    name: str,
+    labels: Optional[Iterable[Any]] = None,
+    build_dir: Optional[Union[str, Path]] = None,
+) -> Tuple[List[Trajectory], List[Any]]:
+    """
+    Loads the trajectories of some labels of a label-partitioned dataset,
+    reading only the files of those labels.
+
+    Parameters
+    ----------
+    name : str
+        Name of the dataset.
+    labels : Optional[Iterable[Any]]
+        Labels to load (in this order), all of them by default. Labels not in
+        the dataset are ignored.
+    build_dir : Optional[Union[str, Path]]
+        Folder containing the built datasets. Defaults to ``TRAJ_BUILD_PATH``.
+
+    Returns
+    -------
+    Tuple[List[Trajectory], List[Any]]
+        Trajectories (with their dataset-wide ids) and labels, grouped by
+        label.
+    """
+    path = _labels_dir(name, build_dir)
+    index = load_shard_index(path)
+    # Labels are compared by their json, as they were partitioned
+    files = {json.dumps(entry["label"]): entry["file"] for entry in index["labels"]}
+    if labels is None:
+        selected = list(files.values())
+    else:
+        keys = [json.dumps(label) for label in labels]
+        selected = [files[key] for key in keys if key in files]
+
+    trajs: List[Trajectory] = []
+    traj_labels: List[Any] = []
+    for file_name in selected:
+        label_trajs, label_labels = read_shard(path / file_name)
+        trajs.extend(label_trajs)
+        traj_labels.extend(label_labels)
+    return trajs, traj_labels
+
+
+# Length of the artifact hash prefix in the decoded file names
+_KEY_LENGTH = 16
+
+_LOADED: "OrderedDict[Tuple[Path, bool], ColumnarDataset]" = OrderedDict()
+_LOADED_LOCK = threading.Lock()
+
+
+def _data_nbytes(data: ColumnarData) -> int:
+    # Memory-mapped arrays are only paged in as they are accessed
+    arrays = (data.r, data.t, data.offsets, data.labels)
+    return sum(arr.nbytes for arr in arrays if not isinstance(arr, np.memmap))
+
+
+def _remember(key: Tuple[Path, bool], dataset: ColumnarDataset):
+    """Adds a dataset to the LRU of loaded datasets, evicting the oldest ones."""
+    limit = config.LOADER_CACHE_MB * 1024**2
+    with _LOADED_LOCK:
+        _LOADED[key] = dataset
+        _LOADED.move_to_end(key)
+        total = sum(_data_nbytes(ds.data) for ds in _LOADED.values())
+        while _LOADED and (total > limit or len(_LOADED) > config.LOADER_CACHE_SIZE):
+            _, evicted = _LOADED.popitem(last=False)
+            total -= _data_nbytes(evicted.data)
+
+
+def clear_loaded():
+    """Forgets the datasets loaded in this process."""
+    with _LOADED_LOCK:
+        _LOADED.clear()
+
+
+def _artifact_path(build_dir: Path, name: str) -> Optional[Path]:
+    """The most recently built json artifact of a dataset, if any."""
+    candidates = [
+        build_dir / f"{name}{ZIP_EXTENSION}",
+        build_dir / f"{name}{ZSTD_EXTENSION}",
+        shards_dir(build_dir, name) / SHARD_INDEX_FILE_NAME,
+    ]
+    existing = [path for path in candidates if path.exists()]
+    return max(existing, key=lambda path: path.stat().st_mtime_ns, default=None)
+
+
+def _artifact_hash(artifact: Path, record_path: Path) -> str:
+    """
+    Hashes an artifact. The hash is recorded along with the artifact size and
+    mtime, so the artifact is only hashed again when it changes.
+    """
+    stat = artifact.stat()
+    record = {
+        "artifact": str(artifact.resolve()),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    prev_record = load_manifest(record_path) or {}
+    if all(prev_record.get(key) == val for key, val in record.items()):
+        return prev_record["sha256"]
+
+    record["sha256"] = file_sha256(artifact)
+    save_manifest(record_path, record)
+    return record["sha256"]
+
+
+def _artifact_docs(artifact: Path) -> Iterator[Dict[str, Any]]:
+    """Json documents (version, trajs and labels) of an artifact."""
+    if artifact.name == SHARD_INDEX_FILE_NAME:
+        index = load_shard_index(artifact.parent)
+        paths = [artifact.parent / shard["file"] for shard in index["shards"]]
+    else:
+        paths = [artifact]
+    for path in paths:
+        with open_input(path) as data_file:
+            yield json.load(data_file)
+
+
+def _decode_artifact(artifact: Path, decoded_path: Path):
+    """Writes the trajectories of a json artifact in the columnar layout."""
+    logging.info("Decoding %s into %s", artifact, decoded_path)
+    docs = _artifact_docs(artifact)
+    first = next(docs)
+    # Other processes may be decoding the same artifact
+    tmp_fd, tmp_name = tempfile.mkstemp(
+        prefix=f".{decoded_path.name}.", suffix=".tmp", dir=decoded_path.parent
+    )
+    os.close(tmp_fd)
+    tmp_path = Path(tmp_name)
+    try:
+        with ColumnarWriter(tmp_path, first["version"]) as writer:
+            for doc in itertools.chain([first], docs):
+                for traj_json, label in zip(doc["trajs"], doc["labels"]):
+                    writer.add_arrays(*json_traj_arrays(traj_json), label)
+        tmp_path.replace(decoded_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _remove_stale_decoded(decoded_dir: Path, name: str, keep: Path):
+    pattern = re.compile(
+        rf"{re.escape(name)}-[0-9a-f]{{{_KEY_LENGTH}}}{re.escape(COLUMNAR_EXTENSION)}"
+    )
+    for path in decoded_dir.glob(f"{name}-*{COLUMNAR_EXTENSION}"):
+        if path != keep and pattern.fullmatch(path.name):
+            path.unlink()
+
+
+def load_dataset(
+    name: str,
+    build_dir: Optional[Union[str, Path]] = None,
+    cache_dir: Optional[Union[str, Path]] = None,
+    mmap: bool = True,
+) -> ColumnarDataset:
+    """
+    Loads a built dataset from its json artifact (``<name>.zip``,
+    ``<name>.json.zst`` or its shards, the most recent one).
+
+    The first time an artifact is loaded it is decoded into the columnar
+    layout, inside ``cache_dir``, keyed on the hash of the artifact. Later
+    loads (from any process) only memory-map the decoded arrays, until the
+    artifact changes. Loaded datasets are also kept in memory (up to
+    ``TRAJ_LOADER_CACHE_SIZE`` datasets and ``TRAJ_LOADER_CACHE_MB`` of arrays
+    read into memory, which only bounds ``mmap=False`` loads, least recently
+    used first out), so loading them again in the same process is free.
+
+    Parameters
+    ----------
+    name : str
+        Name of the dataset.
+    build_dir : Optional[Union[str, Path]]
+        Folder containing the built datasets. Defaults to ``TRAJ_BUILD_PATH``.
+    cache_dir : Optional[Union[str, Path]]
+        Folder of the decoded datasets. Defaults to ``TRAJ_CACHE_PATH/decoded``.
+    mmap : bool
+        If True (default), the decoded arrays are memory-mapped.
+
+    Returns
+    -------
+    ColumnarDataset
+        Sequence of the trajectories of the dataset.
+    """
+    build_dir = Path(config.BUILD_PATH if build_dir is None else build_dir)
+    decoded_dir = Path(config.DECODED_DIR if cache_dir is None else cache_dir)
+    record_path = decoded_dir / f"{name}.json"
+
+    artifact = _artifact_path(build_dir, name)
+    if artifact is not None:
+        decoded_dir.mkdir(parents=True, exist_ok=True)
+        key = _artifact_hash(artifact, record_path)[:_KEY_LENGTH]
+    else:
+        # Only the decoded version of the last loaded artifact is left
+        record = load_manifest(record_path)
+        if record is None:
+            raise FileNotFoundError(
+                f"No built artifact of '{name}' in {build_dir}. "
+                f"Build it with: python build.py {name}"
+            )
+        key = record["sha256"][:_KEY_LENGTH]
+
+    decoded_path = decoded_dir / f"{name}-{key}{COLUMNAR_EXTENSION}"
+    loaded_key = (decoded_path, mmap)
+    with _LOADED_LOCK:
+        dataset = _LOADED.get(loaded_key)
+    if dataset is not None:
+        _remember(loaded_key, dataset)
+        return dataset
+
+    if not decoded_path.exists():
+        if artifact is None:
+            raise FileNotFoundError(
+                f"{decoded_path} not found. Build it with: python build.py {name}"
+            )
+        _decode_artifact(artifact, decoded_path)
+        _remove_stale_decoded(decoded_dir, name, decoded_path)
+
+    dataset = ColumnarDataset(name, load_columnar(decoded_path, mmap=mmap))
+    _remember(loaded_key, dataset)
+    return dataset
+
+
+def load_summary(name: str, build_dir: Optional[Union[str, Path]] = None) -> Summary:
+    """
+    Loads the per-trajectory summary of a dataset (see ``utils/summary.py``),
+    to select trajectories without loading them. For instance::
+
+        summary = load_summary("geolife")
+        ids = summary.ids[summary.duration > 600]
+        trajs = load_trajectories("geolife", ids)
+    """
+    build_dir = Path(config.BUILD_PATH if build_dir is None else build_dir)
+    path = build_dir / f"{name}{SUMMARY_EXTENSION}"
+    if not path.exists():
+        raise FileNotFoundError(
+            f"{path} not found. Build it with: python build.py {name}"
+        )
+    return read_summary(path)
+
+
+def load_trajectories(
+    name: str,
+    ids: Iterable[int],
+    build_dir: Optional[Union[str, Path]] = None,
+) -> List[Trajectory]:
+    """
+    Loads only the trajectories with the given ids (e.g. selected from the
+    summary of the dataset), through ``load_dataset``.
+    """
+    dataset = load_dataset(name, build_dir)
+    return [dataset[int(traj_id)] for traj_id in ids]
+
+
+def load_spatial_index(
+    name: str, build_dir: Optional[Union[str, Path]] = None
+) -> SpatialIndex:
+    """Loads the spatial index of a dataset (see ``utils/spatial.py``)."""
+    build_dir = Path(config.BUILD_PATH if build_dir is None else build_dir)
+    path = build_dir / f"{name}{SPATIAL_INDEX_EXTENSION}"
+    if not path.exists():
+        raise FileNotFoundError(
+            f"{path} not found. Build it with: python build.py {name} --spatial-index"
+        )
+    return read_spatial_index(path)
+
+
+def _points_getter(name: str, build_dir: Optional[Union[str, Path]]):
+    data = load_dataset(name, build_dir).data
+
+    def points(traj_id: int, start: int, end: int) -> np.ndarray:
+        offset = data.offsets[traj_id]
+        return data.r[offset + start : offset + end]
+
+    return points
+
+
+def query_bbox(
+    name: str,
+    low,
+    high,
+    exact: bool = False,
+    build_dir: Optional[Union[str, Path]] = None,
+) -> np.ndarray:
+    """
+    Ids of the trajectories of a dataset passing through the box
+    ``[low, high]``, using its spatial index.
+
+    Without ``exact`` the ids are candidates (trajectories with a chunk of
+    points whose bounding box intersects the query box). With ``exact`` the
+    points of the candidates are also checked (through ``load_dataset``).
+    """
+    index = load_spatial_index(name, build_dir)
+    points = _points_getter(name, build_dir) if exact else None
+    return index.query_bbox(low, high, points)
+
+
+def query_radius(
+    name: str,
+    center,
+    radius: float,
+    exact: bool = False,
+    build_dir: Optional[Union[str, Path]] = None,
+) -> np.ndarray:
+    """
+    Ids of the trajectories of a dataset passing within ``radius`` of
+    ``center`` (euclidean distance, in the units of the coordinates, e.g.
+    degrees for latitude and longitude). See ``query_bbox``.
+    """
+    index = load_spatial_index(name, build_dir)
+    points = _points_getter(name, build_dir) if exact else None
+    return index.query_radius(center, radius, points)
@@ -1,12 +1,13 @@
 import csv
 import logging
-from datetime import datetime
 from pathlib import Path
 from typing import Any, Dict, List, Tuple
 
+import numpy as np
 import utm
 from yupi import Trajectory
 
+from utils.timestamps import parse_datetimes
 from utils.utils import download_dataset
 
 VERSION = 0
@@ -19,6 +20,10 @@ _ANIMALS_TRACKS = (
 
 LABELS = {"E": "Elk", "D": "Deer", "C": "Cattle"}
 
+# Columns used from the raw data (as named in its header)
+_COLUMNS = (" Id", " Species", " LocDate", " LocTime", " UTME", " UTMN")
+_UTM_ZONE = 11
+
 
 def build() -> Tuple[List[Trajectory], List[Any]]:
     raw_dir = _fetch_raw_data()
@@ -32,63 +37,62 @@ def _fetch_raw_data() -> Path:
     return raw_trajs_filepath.parent
 
 
-def _get_datetime(date_str: str, time_str: str) -> datetime:
-    return datetime.strptime(
-        date_str.strip() + " " + time_str.strip(), "%Y%m%d %H:%M:%S"
-    )
-
-
-def _process_animal(animal_rows) -> Tuple[Trajectory, str]:
-    for row in animal_rows:
-        row["time"] = _get_datetime(row[" LocDate"], row[" LocTime"])
-
-    sorted_rows = sorted(animal_rows, key=lambda x: x["time"])
-
-    lat, long, time = [], [], []
-    start_time = None
-    label = animal_rows[0][" Species"]
-    for i, row in enumerate(sorted_rows):
-        if start_time is None:
-            start_time = _get_datetime(row[" LocDate"], row[" LocTime"])
-            time.append(0)
-        else:
-            _time = _get_datetime(row[" LocDate"], row[" LocTime"])
-            new_time = (_time - start_time).total_seconds()
-            if new_time == time[-1]:
-                continue
-            assert (
-                new_time > time[-1]
-            ), f"Time is not increasing: {new_time} <= {time[-1]}. {i}: {_time}"
-            time.append(new_time)
-
-        assert row[" Species"] == label
-
-        utm_e = int(row[" UTME"])
-        utm_n = int(row[" UTMN"])
-        _lat, _long = utm.to_latlon(utm_e, utm_n, 11, northern=True)
-        lat.append(_lat)
-        long.append(_long)
-
+def _load_columns(raw_file: Path) -> Dict[str, np.ndarray]:
+    """Loads the used columns of the raw data as (stripped) string arrays."""
+    with open(raw_file, encoding="utf-8") as file:
+        header = next(csv.reader(file))
+        data = np.loadtxt(
+            file,
+            dtype=str,
+            delimiter=",",
+            comments=None,
+            usecols=[header.index(col) for col in _COLUMNS],
+            ndmin=2,
+        )
+    return {col.strip(): np.char.strip(data[:, i]) for i, col in enumerate(_COLUMNS)}
+
+
+def _process_animal(
+    species: np.ndarray, times: np.ndarray, utm_e: np.ndarray, utm_n: np.ndarray
+) -> Tuple[Trajectory, str]:
+    """Creates the trajectory of an animal from its rows (in file order)."""
+    label = species[0]
+    order = np.argsort(times, kind="stable")
+    times = times[order]
+
+    # Remove rows with repeated time
+    keep = np.ones(len(times), dtype=bool)
+    keep[1:] = times[1:] != times[:-1]
+    order = order[keep]
+
+    assert np.all(species[order] == label), "Species is not unique"
+
+    time = (times[keep] - times[0]).astype(np.float64)
+    lat, long = utm.to_latlon(utm_e[order], utm_n[order], _UTM_ZONE, northern=True)
     return Trajectory(x=long, y=lat, t=time), LABELS[label]
 
 
 def _yupify(raw_dir) -> Tuple[List[Trajectory], List[str]]:
     # Loads the raw data and preprocess it
     logging.info("Preprocessing Animals raw data")
-    rows_dict: Dict[str, Any] = {}
-    with open(
-        raw_dir / "Starkey_OR_Main_Telemetry_1993-1996_Data.txt", encoding="utf-8"
-    ) as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            _id: str = row[" Id"]
-            if _id not in rows_dict:
-                rows_dict[_id] = []
-            rows_dict[_id].append(row)
+    columns = _load_columns(raw_dir / "Starkey_OR_Main_Telemetry_1993-1996_Data.txt")
+    timestamps = np.char.add(np.char.add(columns["LocDate"], " "), columns["LocTime"])
+    times = parse_datetimes(timestamps, "%Y%m%d %H:%M:%S")
+    utm_e = columns["UTME"].astype(np.int64)
+    utm_n = columns["UTMN"].astype(np.int64)
+
+    # Group the rows by animal, keeping the animals in order of appearance
+    rows = np.argsort(columns["Id"], kind="stable")
+    ids = columns["Id"][rows]
+    starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+    groups = np.split(rows, starts[1:])
+    groups.sort(key=lambda group: group[0])
 
     trajs, labels = [], []
-    for rows in rows_dict.values():
-        traj, label = _process_animal(rows)
+    for group in groups:
+        traj, label = _process_animal(
+            columns["Species"][group], times[group], utm_e[group], utm_n[group]
+        )
         trajs.append(traj)
         labels.append(label)
     return trajs, labels
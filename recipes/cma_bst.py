@@ -1,12 +1,13 @@
 import csv
 import logging
-from datetime import datetime
 from pathlib import Path
 from typing import Any, List, Tuple
 
+import numpy as np
 from scipy.io.matlab import loadmat
 from yupi import Trajectory
 
+from utils.timestamps import elapsed_seconds, parse_datetimes
 from utils.utils import download_dataset
 
 VERSION = 0
@@ -38,21 +39,12 @@ def _fetch_raw_data() -> Path:
     return raw_trajs_filepath.parent
 
 
-def _get_datetime(date_str: str) -> datetime:
-    return datetime.strptime(date_str.strip(), "%Y%m%d%H")
-
-
-def _process_huracane(hur_rows: List[str]) -> Tuple[Trajectory, str]:
-    lat, long, time, max_cat = [], [], [], 0
-    start_time = None
+def _process_huracane(
+    hur_rows: List[List[str]], hur_times: np.ndarray
+) -> Tuple[Trajectory, str]:
+    lat, long, max_cat = [], [], 0
+    time = elapsed_seconds(hur_times)
     for row in hur_rows:
-        if start_time is None:
-            start_time = _get_datetime(row[0])
-            time.append(0)
-        else:
-            _time = _get_datetime(row[0])
-            time.append((_time - start_time).total_seconds())
-
         max_cat = max(max_cat, int(row[1]))
         lat.append(float(row[2]))
         long.append(float(row[3]))
@@ -68,17 +60,25 @@ def _yupify(raw_dir) -> Tuple[List[Trajectory], List[str]]:
     trajs, labels = [], []
 
     for year_file in raw_dir.glob("*.txt"):
+        hurricanes: List[List[List[str]]] = []
         with open(year_file, "r", encoding="utf-8") as file:
             reader = csv.reader(file, delimiter=" ")
-            hur_rows = []
+            hur_rows: List[List[str]] = []
             for row in reader:
                 row = [item for item in row if item]
                 if row[0].startswith("66666"):
                     if len(hur_rows) > 2:
-                        traj, label = _process_huracane(hur_rows)
-                        trajs.append(traj)
-                        labels.append(label)
+                        hurricanes.append(hur_rows)
                     hur_rows = []
                     continue
                 hur_rows.append(row)
+
+        # Parses the timestamps of all the hurricanes of the year at once
+        timestamps = [row[0] for rows in hurricanes for row in rows]
+        times = parse_datetimes(timestamps, "%Y%m%d%H")
+        offsets = np.cumsum([0] + [len(rows) for rows in hurricanes])
+        for hur_rows, start, end in zip(hurricanes, offsets[:-1], offsets[1:]):
+            traj, label = _process_huracane(hur_rows, times[start:end])
+            trajs.append(traj)
+            labels.append(label)
     return trajs, labels
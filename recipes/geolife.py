@@ -1,12 +1,17 @@
+import hashlib
+import json
 import logging
 from datetime import datetime
 from pathlib import Path
-from typing import Any, List, NamedTuple, Tuple
+from typing import Any, List, NamedTuple, Optional, Tuple
 
 import numpy as np
 from yupi import Trajectory
 
-from utils.utils import download_dataset, _get_progress_log
+import config as cfg
+from utils.rawfs import RawPath, raw_data
+from utils.timestamps import parse_datetimes
+from utils.utils import _get_path, download_dataset, _get_progress_log
 
 NAME = "geolife"
 VERSION = 0
@@ -22,18 +27,35 @@ LabelData = NamedTuple(
 )
 
 
-Register = Tuple[float, float, datetime]
-"""Register data (GPS point and time) in the form: lat, lon, time"""
+class Registers(NamedTuple):
+    """Columns of several registers"""
+
+    lat: np.ndarray
+    lon: np.ndarray
+    time: np.ndarray
+    """Timestamps as datetime64[s]"""
+
+
+_PLT_HEADER_LINES = 6
+_LABEL_FMT = "%Y/%m/%d %H:%M:%S"
+_MIN_TRAJ_POINTS = 5
+_SECONDS_PER_DAY = 24 * 60 * 60
+_PLT_DTYPE = np.dtype(
+    [("lat", np.float64), ("lon", np.float64), ("date", "U10"), ("time", "U8")]
+)
+
+# Bump when the parsing of the PLT files changes, to invalidate the cache
+_REGISTERS_CACHE_VERSION = 0
 
 
 def build() -> Tuple[List[Trajectory], List[Any]]:
     raw_data_file = download_dataset(_GEOLIFE_URL, NAME)
 
-    raw_dir = raw_data_file.parent
-    return yupify(raw_dir)
+    with raw_data(raw_data_file) as raw_dir:
+        return yupify(raw_dir, _get_path(cfg.DS_DIR, NAME) / "registers")
 
 
-def yupify(raw_dir: Path):
+def yupify(raw_dir: RawPath, cache_dir: Optional[Path] = None):
     # Loads the raw data and preprocess it
     raw_metadata = []
     logging.info("Preprocessing GeoLife raw data")
@@ -41,7 +63,7 @@ def yupify(raw_dir: Path):
     usr_folders = list(sorted(usr_folders_path.iterdir()))
     for i, usr in enumerate(usr_folders):
         print(_get_progress_log(i + 1, len(usr_folders)), end="\r", flush=True)
-        _process_usr_trajs(usr, raw_metadata)
+        _process_usr_trajs(usr, raw_metadata, cache_dir)
 
     # Load the preprocessed data and create the yupi trajectories
     logging.info("Creating yupi trajectories")
@@ -57,81 +79,175 @@ def yupify(raw_dir: Path):
     return trajs, lables
 
 
-def _load_labels(labels_file: Path) -> List[LabelData]:
+def _load_labels(labels_file: RawPath) -> List[LabelData]:
     """Loads the labels of a user."""
-    with open(labels_file, "r", encoding="utf-8") as l_file:
-        labels = [_parse_label(line) for line in l_file.readlines()[1:]]
-    return labels
-
-
-def _process_usr_trajs(usr_folder: Path, raw_metadata: List[dict]) -> None:
-    """Processes the trajectories of a user."""
+    with labels_file.open("r", encoding="utf-8") as l_file:
+        rows = [line.split() for line in l_file.readlines()[1:]]
+
+    # Label bounds are parsed as a whole column
+    starts = parse_datetimes([f"{row[0]} {row[1]}" for row in rows], _LABEL_FMT)
+    ends = parse_datetimes([f"{row[2]} {row[3]}" for row in rows], _LABEL_FMT)
+    return [
+        LabelData(start_dt, end_dt, row[4])
+        for start_dt, end_dt, row in zip(starts.tolist(), ends.tolist(), rows)
+    ]
+
+
+def _label_segments(
+    reg_times: np.ndarray, labels: List[LabelData]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Finds the registers slice of each label.
+
+    Registers are swept once in time order: each label only takes the
+    registers inside its bounds that come after the ones consumed by the
+    previous label, and a label is closed when a register beyond its end is
+    found. Labels that are never closed (no registers after them) are
+    discarded.
+
+    Returns the start and end index of each label segment and a mask of the
+    closed labels.
+    """
+    starts = np.array([label.start_dt for label in labels], dtype="datetime64[s]")
+    ends = np.array([label.end_dt for label in labels], dtype="datetime64[s]")
+
+    first_inside = np.searchsorted(reg_times, starts, side="left")
+    last_inside = np.searchsorted(reg_times, ends, side="right")
+    label_close = np.searchsorted(reg_times, np.maximum(starts, ends), side="right")
+
+    sweep = np.maximum.accumulate(np.concatenate(([0], label_close)))
+    seg_starts = np.maximum(sweep[:-1], first_inside)
+    seg_ends = np.maximum(seg_starts, last_inside)
+    closed = sweep[1:] < len(reg_times)
+    return seg_starts, seg_ends, closed
+
+
+def _process_usr_trajs(
+    usr_folder: RawPath, raw_metadata: List[dict], cache_dir: Optional[Path] = None
+) -> None:
+    """
+    Processes the trajectories of a user.
+
+    If ``cache_dir`` is given, the parsed registers of the user are cached
+    there (see ``_cached_registers``).
+    """
     labels_file = usr_folder / "labels.txt"
     if not labels_file.exists():
         return
 
     labels = _load_labels(labels_file)
-    all_regs = _load_registers(usr_folder)
-
-    label_idx = 0
-    regs_idx = 0
-    label = labels[label_idx]
-    traj: List[List[float]] = []
-    while regs_idx < len(all_regs):
-        lat, long, reg_dt = all_regs[regs_idx]
-
-        # Register inside label bounds
-        if label.start_dt <= reg_dt <= label.end_dt:
-            time = (reg_dt - label.start_dt).seconds
-            if not traj or time != traj[-1][-1]:
-                traj.append([lat, long, time])
-
-        # Register outside label bounds
-        elif label.start_dt < reg_dt:
-            # Save the trajectory if it has at least 5 points
-            if len(traj) > 5:
-                raw_metadata.append(
-                    {
-                        "id": f"{usr_folder.name}_{label_idx}",
-                        "traj_data": np.array(traj),
-                        "label": label.name,
-                    }
-                )
-            traj.clear()
-
-            # Move to the next label
-            label_idx += 1
-            if label_idx >= len(labels):
-                break
-            label = labels[label_idx]
-            continue  # Don't increment regs_idx yet
-        regs_idx += 1
-
-
-def _load_registers(usr_folder: Path) -> List[Register]:
+    if not labels:
+        return
+    if cache_dir is None:
+        regs = _load_registers(usr_folder)
+    else:
+        regs = _cached_registers(usr_folder, cache_dir)
+
+    if np.any(regs.time[1:] < regs.time[:-1]):
+        order = np.argsort(regs.time, kind="stable")
+        regs = Registers(regs.lat[order], regs.lon[order], regs.time[order])
+
+    seg_starts, seg_ends, closed = _label_segments(regs.time, labels)
+    for label_idx in np.flatnonzero(closed):
+        start, end = seg_starts[label_idx], seg_ends[label_idx]
+        if end - start <= _MIN_TRAJ_POINTS:
+            continue
+
+        # Seconds since the label start (day component excluded)
+        label = labels[label_idx]
+        elapsed = regs.time[start:end] - np.datetime64(label.start_dt, "s")
+        time = elapsed.astype(np.int64) % _SECONDS_PER_DAY
+
+        # Remove registers with repeated time
+        keep = np.ones(len(time), dtype=bool)
+        keep[1:] = time[1:] != time[:-1]
+
+        # Save the trajectory if it has more than 5 points
+        if np.count_nonzero(keep) > _MIN_TRAJ_POINTS:
+            raw_metadata.append(
+                {
+                    "id": f"{usr_folder.name}_{label_idx}",
+                    "traj_data": np.column_stack(
+                        (
+                            regs.lat[start:end][keep],
+                            regs.lon[start:end][keep],
+                            time[keep].astype(np.float64),
+                        )
+                    ),
+                    "label": label.name,
+                }
+            )
+
+
+def _registers_key(usr_folder: RawPath) -> str:
+    """Fingerprint of the PLT files of a user (names, sizes and mtimes)."""
+    plt_files = []
+    for plt in sorted((usr_folder / "Trajectory").iterdir()):
+        stat = plt.stat()
+        plt_files.append([plt.name, stat.st_size, stat.st_mtime])
+    key = json.dumps([_REGISTERS_CACHE_VERSION, plt_files])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _cached_registers(usr_folder: RawPath, cache_dir: Path) -> Registers:
+    """
+    Loads all the registers of a user, parsing its PLT files only if they
+    changed since they were cached.
+
+    The registers are cached as ``<user>.npz`` (uncompressed) along with the
+    fingerprint of the PLT files, so changes in the processing of the
+    registers do not require parsing them again.
+    """
+    key = _registers_key(usr_folder)
+    cache_path = cache_dir / f"{usr_folder.name}.npz"
+    try:
+        with np.load(cache_path, allow_pickle=False) as cached:
+            if str(cached["key"]) == key:
+                return Registers(cached["lat"], cached["lon"], cached["time"])
+    except (OSError, KeyError, ValueError):
+        pass
+
+    regs = _load_registers(usr_folder)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f"{cache_path.name}.tmp")
+    with open(tmp_path, "wb") as cache_file:
+        np.savez(cache_file, key=np.str_(key), **regs._asdict())
+    tmp_path.replace(cache_path)
+    return regs
+
+
+def _load_registers(usr_folder: RawPath) -> Registers:
     """Loads all the registers of a user."""
-    all_regs = []
     trajs_folder = usr_folder / "Trajectory"
     sorted_paths = sorted(trajs_folder.iterdir())
-    for plt in sorted_paths:
-        with open(plt, "r", encoding="utf-8") as reg:
-            registers = [_parse_register(line) for line in reg.readlines()[6:]]
-            all_regs += registers
-    return all_regs
-
-
-def _parse_register(line: str) -> Register:
-    """Parses a register line."""
-    reg = line.strip().split(",")
-    lat, lon = float(reg[0]), float(reg[1])
-    _dt = datetime.strptime(f"{reg[5]} {reg[6]}", "%Y-%m-%d %H:%M:%S")
-    return lat, lon, _dt
-
-
-def _parse_label(line: str) -> LabelData:
-    """Parses a label line."""
-    items = line.split()
-    start_dt = datetime.strptime(f"{items[0]} {items[1]}", "%Y/%m/%d %H:%M:%S")
-    end_dt = datetime.strptime(f"{items[2]} {items[3]}", "%Y/%m/%d %H:%M:%S")
-    clsf = items[4]
-    return LabelData(start_dt, end_dt, clsf)
+    plt_regs = [_parse_plt(plt) for plt in sorted_paths]
+    if not plt_regs:
+        return Registers(
+            lat=np.empty(0, dtype=np.float64),
+            lon=np.empty(0, dtype=np.float64),
+            time=np.empty(0, dtype="datetime64[s]"),
+        )
+    return Registers(
+        lat=np.concatenate([regs.lat for regs in plt_regs]),
+        lon=np.concatenate([regs.lon for regs in plt_regs]),
+        time=np.concatenate([regs.time for regs in plt_regs]),
+    )
+
+
+def _parse_plt(plt: RawPath) -> Registers:
+    """Parses all the registers of a PLT file at once."""
+    with plt.open("r", encoding="utf-8") as plt_file:
+        data = np.loadtxt(
+            plt_file,
+            dtype=_PLT_DTYPE,
+            delimiter=",",
+            skiprows=_PLT_HEADER_LINES,
+            usecols=(0, 1, 5, 6),
+            ndmin=1,
+        )
+    timestamps = np.char.add(np.char.add(data["date"], "T"), data["time"])
+    return Registers(
+        lat=data["lat"],
+        lon=data["lon"],
+        time=timestamps.astype("datetime64[s]"),
+    )
@@ -1,11 +1,12 @@
 import csv
 import logging
-from datetime import datetime
 from pathlib import Path
 from typing import Any, List, Tuple
 
+import numpy as np
 from yupi import Trajectory
 
+from utils.timestamps import elapsed_seconds, parse_datetimes
 from utils.utils import download_dataset
 
 VERSION = 0
@@ -39,24 +40,12 @@ def _get_saffir_simpson_scale(max_wind_speed: float) -> int:
     return 0
 
 
-def _get_datetime(date_str: str, time_str: str) -> datetime:
-    _date = datetime.strptime(date_str.strip(), "%Y%m%d")
-    _time = datetime.strptime(time_str.strip(), "%H%M")
-    _datetime = datetime.combine(_date, _time.time())
-    return _datetime
-
-
-def _process_huracane(hur_rows: List[List[str]]) -> Tuple[Trajectory, int]:
-    lat, long, time, max_wind_speed = [], [], [], -1.0
-    start_time = None
+def _process_huracane(
+    hur_rows: List[List[str]], hur_times: np.ndarray
+) -> Tuple[Trajectory, int]:
+    lat, long, max_wind_speed = [], [], -1.0
+    time = elapsed_seconds(hur_times)
     for row in hur_rows:
-        if start_time is None:
-            start_time = _get_datetime(row[0], row[1])
-            time.append(0)
-        else:
-            _time = _get_datetime(row[0], row[1])
-            time.append((_time - start_time).total_seconds())
-
         assert row[4][-1] == "N" or row[4][-1] == "S"
         assert row[5][-1] == "W" or row[5][-1] == "E"
         lat.append(float(row[4][:-1]))
@@ -76,17 +65,28 @@ def _yupify(raw_dir) -> Tuple[List[Trajectory], List[int]]:
     # Loads the raw data and preprocess it
     logging.info("Preprocessing Huracane raw data")
     mat_file = raw_dir / "hurdat2-1851-2021-100522.txt"
-    trajs, labels = [], []
+    hurricanes: List[List[List[str]]] = []
     with open(mat_file, "r", encoding="utf-8") as file:
         reader = csv.reader(file, delimiter=",")
-        hur_rows = []
+        hur_rows: List[List[str]] = []
         for row in reader:
             if row[0].startswith("AL"):
                 if len(hur_rows) > 2:
-                    traj, label = _process_huracane(hur_rows)
-                    trajs.append(traj)
-                    labels.append(label)
+                    hurricanes.append(hur_rows)
                 hur_rows = []
                 continue
             hur_rows.append(row)
+
+    # Parses the timestamps of all the hurricanes at once
+    timestamps = [
+        row[0].strip() + row[1].strip() for rows in hurricanes for row in rows
+    ]
+    times = parse_datetimes(timestamps, "%Y%m%d%H%M")
+    offsets = np.cumsum([0] + [len(rows) for rows in hurricanes])
+
+    trajs, labels = [], []
+    for hur_rows, start, end in zip(hurricanes, offsets[:-1], offsets[1:]):
+        traj, label = _process_huracane(hur_rows, times[start:end])
+        trajs.append(traj)
+        labels.append(label)
     return trajs, labels
@@ -1,13 +1,18 @@
+import gzip
 import logging
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
 from string import Template
-from typing import Any, List, Tuple
+from typing import Any, Deque, Dict, Iterator, List, Tuple
 
 import numpy as np
 from yupi import Trajectory
 
 import config as cfg
-from utils.utils import _get_path, download_dataset
+from utils.rawfs import iter_members
+from utils.utils import _get_path, download_datasets
 
 VERSION = 0
 NAME = "mnist_stroke"
@@ -16,6 +21,11 @@ _SEQUENCES_URL = "https://github.com/edwin-de-jong/mnist-digits-stroke-sequence-
 _TRAIN_LABELS_URL = "http://yann.lecun.com/exdb/mnist/train-labels-idx1-ubyte.gz"
 _TEST_LABELS_URL = "http://yann.lecun.com/exdb/mnist/t10k-labels-idx1-ubyte.gz"
 
+# Number of points files parsed by each worker task
+_CHUNK_SIZE = 2000
+# Chunks submitted (and not collected yet) per worker
+_PENDING_CHUNKS_PER_WORKER = 2
+
 
 def build() -> Tuple[List[Trajectory], List[Any]]:
     raw_dir = _fetch_raw_data()
@@ -23,46 +33,86 @@ def build() -> Tuple[List[Trajectory], List[Any]]:
 
 
 def _fetch_raw_data() -> Path:
-    raw_trajs_filepath = download_dataset(_SEQUENCES_URL, NAME)
-    download_dataset(_TRAIN_LABELS_URL, NAME)
-    download_dataset(_TEST_LABELS_URL, NAME)
+    # The archives are read in place, there is no need to extract them
+    raw_trajs_filepath, *_ = download_datasets(
+        [_SEQUENCES_URL, _TRAIN_LABELS_URL, _TEST_LABELS_URL], NAME, uncompress=False
+    )
     return raw_trajs_filepath.parent
 
 
 def _read_labels(label_file: Path, count: int) -> List[str]:
-    with open(label_file, "rb") as f:
+    with gzip.open(label_file, "rb") as f:
         f.read(8)  # discard header info
         return [str(l) for l in f.read(count)]
 
 
-def _read_traj(trajectory_file: Path) -> Trajectory:
-    # Load raw data from the stroke
-    traj = np.loadtxt(trajectory_file, delimiter=",", skiprows=1)
+def _parse_points(raw_points: bytes) -> np.ndarray:
+    # Skip the header and parse all the values at once
+    values = raw_points.split(b"\n", 1)[1].replace(b",", b" ").decode()
+    points = np.fromstring(values, dtype=np.float64, sep=" ").reshape(-1, 2)
 
     # Filter tokens from changes
-    points = [(i, j) for i, j in traj if i >= 0 and j >= 0]
-
-    return Trajectory(points=points)
+    return points[(points >= 0).all(axis=1)]
+
+
+def _parse_points_chunk(chunk: List[bytes]) -> List[np.ndarray]:
+    return [_parse_points(raw_points) for raw_points in chunk]
+
+
+def _iter_points_chunks(
+    sequences_file: Path,
+) -> Iterator[Tuple[List[str], List[bytes]]]:
+    """Reads the points files straight from the archive, in chunks."""
+    names: List[str] = []
+    chunk: List[bytes] = []
+    for member_name, member_file in iter_members(sequences_file):
+        file_name = member_name.rsplit("/", 1)[-1]
+        if not file_name.endswith("-points.txt"):
+            continue
+        names.append(file_name)
+        chunk.append(member_file.read())
+        if len(chunk) == _CHUNK_SIZE:
+            yield names, chunk
+            names, chunk = [], []
+    if chunk:
+        yield names, chunk
+
+
+def _read_points(sequences_file: Path) -> Dict[str, np.ndarray]:
+    """
+    Parses all the points files of the archive in parallel.
+
+    Only a few chunks per worker are in flight at a time, so the archive is
+    not read (and parsed) faster than the results are collected.
+    """
+    points: Dict[str, np.ndarray] = {}
+    max_workers = os.cpu_count() or 1
+    max_pending = _PENDING_CHUNKS_PER_WORKER * max_workers
+    pending: Deque[Tuple["Future[List[np.ndarray]]", List[str]]] = deque()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for names, chunk in _iter_points_chunks(sequences_file):
+            pending.append((executor.submit(_parse_points_chunk, chunk), names))
+            if len(pending) >= max_pending:
+                future, done_names = pending.popleft()
+                points.update(zip(done_names, future.result()))
+        for future, names in pending:
+            points.update(zip(names, future.result()))
+    return points
 
 
 def _read_trajs(
-    sequence_folder: Path, template: Template, count: int
+    points: Dict[str, np.ndarray], template: Template, count: int
 ) -> List[Trajectory]:
-    trajs = []
-    for i in range(count):
-        traj_path = sequence_folder / template.substitute(id=i)
-        trajs.append(_read_traj(traj_path))
-
-    return trajs
+    return [Trajectory(points=points[template.substitute(id=i)]) for i in range(count)]
 
 
 def _yupify_mnist(
-    sequence_folder: Path, label_file: Path, template: Template, count: int
+    points: Dict[str, np.ndarray], label_file: Path, template: Template, count: int
 ) -> Tuple[List[Trajectory], List[str]]:
     """Yupifies a part of the dataset"""
 
     labels = _read_labels(label_file, count)
-    trajs = _read_trajs(sequence_folder, template, count)
+    trajs = _read_trajs(points, template, count)
 
     return trajs, labels
 
@@ -70,20 +120,23 @@ def _yupify_mnist(
 def _yupify(raw_dir) -> Tuple[List[Trajectory], List[str]]:
     # Loads the raw data and preprocess it
     logging.info("Preprocessing MNIST stroke raw data")
-    sequence_path = raw_dir / "sequences"
-    train_labels_path = raw_dir / "train-labels.idx1-ubyte"
-    test_labels_path = raw_dir / "t10k-labels.idx1-ubyte"
+    sequences_file = raw_dir / "sequences.tar.gz"
+    train_labels_path = raw_dir / "train-labels-idx1-ubyte.gz"
+    test_labels_path = raw_dir / "t10k-labels-idx1-ubyte.gz"
+
+    logging.info("Parsing strokes...")
+    points = _read_points(sequences_file)
 
     logging.info("Yupifying train dataset...")
     train_template = Template("trainimg-$id-points.txt")
     trajs_train, labels_train = _yupify_mnist(
-        sequence_path, train_labels_path, template=train_template, count=60000
+        points, train_labels_path, template=train_template, count=60000
     )
 
     logging.info("Yupifying test dataset...")
     test_template = Template("testimg-$id-points.txt")
     trajs_test, labels_test = _yupify_mnist(
-        sequence_path, test_labels_path, template=test_template, count=10000
+        points, test_labels_path, template=test_template, count=10000
     )
 
     return trajs_train + trajs_test, labels_train + labels_test
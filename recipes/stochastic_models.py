@@ -1,5 +1,6 @@
 import logging
-from typing import Any, List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import numpy as np
 from yupi import Trajectory
@@ -7,7 +8,7 @@ from yupi.generators import DiffDiffGenerator, LangevinGenerator, RandomWalkGene
 
 # Dataset metadata
 NAME = "stochastic_models"
-VERSION = 0
+VERSION = 1
 
 # Trajectory-specific parameters
 DIM = 2
@@ -17,31 +18,51 @@ RANG_DT = [1e-3, 1e-1]
 RANG_T = [8, 20]
 N_TRAJS = 1000
 
+# Generation parameters. Every batch and every trajectory has its own random
+# stream (spawned from SEED), so the result does not depend on the number of
+# workers (None means one per cpu)
+SEED = 0
+BATCH_SIZE = 100
+N_WORKERS: Optional[int] = None
+
 
 # Build a new instance of the dataset
 def build() -> Tuple[List[Trajectory], List[Any]]:
-    trajs, labels = [], []
-    model_builders = _build_langevin, _build_random_walk, _build_diffdiff
     logging.info("Generating stochastic models dataset")
-    for mb in model_builders:
-        tl, ll = mb(N_TRAJS)
-        trajs += tl
-        labels += ll
-    return trajs, labels
+    tasks = []
+    model_seeds = np.random.SeedSequence(SEED).spawn(len(_MODELS))
+    for label, model_seed in zip(_MODELS, model_seeds):
+        n_batches = -(-N_TRAJS // BATCH_SIZE)
+        for i, batch_seed in enumerate(model_seed.spawn(n_batches)):
+            batch_size = min(BATCH_SIZE, N_TRAJS - i * BATCH_SIZE)
+            tasks.append((label, batch_size, batch_seed))
 
-
-seed = 0
+    trajs, labels = [], []
+    with ProcessPoolExecutor(max_workers=N_WORKERS) as executor:
+        batches = executor.map(_generate_batch, *zip(*tasks))
+        for (label, *_), batch_trajs in zip(tasks, batches):
+            trajs += batch_trajs
+            labels += [label] * len(batch_trajs)
+    return trajs, labels
 
 
-def get_seed() -> int:
-    global seed
-    seed += 1
-    return seed
+def _generate_batch(
+    label: str, n_trajs: int, seed_seq: np.random.SeedSequence
+) -> List[Trajectory]:
+    """Generates a batch of trajectories of a model."""
+    params_seed, *traj_seeds = seed_seq.spawn(n_trajs + 1)
+    generator_cls, draw_params = _MODELS[label]
+    params = draw_params(np.random.default_rng(params_seed), n_trajs)
 
+    trajs = []
+    for traj_params, traj_seed in zip(params, traj_seeds):
+        seed = int(traj_seed.generate_state(1, np.uint64)[0])
+        generator = generator_cls(dim=DIM, N=1, seed=seed, **traj_params)
+        trajs.append(*generator.generate())
+    return trajs
 
-def _build_langevin(n_trajs: int) -> Tuple[List[Trajectory], List[Any]]:
-    rng = np.random.default_rng(seed)
 
+def _langevin_params(rng: np.random.Generator, n_trajs: int) -> List[Dict[str, Any]]:
     tau = rng.uniform(*RANG_T_SCALE, size=n_trajs)
     T = tau * rng.uniform(*RANG_T, size=n_trajs)
     dt = tau * rng.uniform(*RANG_DT, size=n_trajs)
@@ -49,67 +70,43 @@ def _build_langevin(n_trajs: int) -> Tuple[List[Trajectory], List[Any]]:
     sigma = rng.permutation(r) / (tau * np.sqrt(tau))
     gamma = 1 / tau
 
-    trajs, labels = [], []
-    for T_, dt_, gamma_, sigma_ in zip(T, dt, gamma, sigma):
-        lg_gen = LangevinGenerator(
-            T=T_,
-            dim=DIM,
-            N=1,
-            dt=dt_,
-            gamma=gamma_,
-            sigma=sigma_,
-            seed=get_seed(),
-        )
-        trajs.append(*lg_gen.generate())
-        labels.append("Langevin")
-
-    return trajs, labels
+    return [
+        {"T": T_, "dt": dt_, "gamma": gamma_, "sigma": sigma_}
+        for T_, dt_, gamma_, sigma_ in zip(T, dt, gamma, sigma)
+    ]
 
 
-def _build_diffdiff(n_trajs: int) -> Tuple[List[Trajectory], List[Any]]:
-    rng = np.random.default_rng(seed)
-
+def _diffdiff_params(rng: np.random.Generator, n_trajs: int) -> List[Dict[str, Any]]:
     tau = rng.uniform(*RANG_T_SCALE, size=n_trajs)
     T = tau * rng.uniform(*RANG_T, size=n_trajs)
     dt = tau * rng.uniform(*RANG_DT, size=n_trajs)
     r = rng.uniform(*RANG_R_SCALE, size=n_trajs)
     sigma = rng.permutation(r) / (tau * np.sqrt(tau))
 
-    trajs, labels = [], []
-    for T_, dt_, tau_, sigma_ in zip(T, dt, tau, sigma):
-        dfdf_gen = DiffDiffGenerator(
-            T=T_,
-            dim=DIM,
-            N=1,
-            dt=dt_,
-            tau=tau_,
-            sigma=sigma_,
-            seed=get_seed(),
-        )
-        trajs.append(*dfdf_gen.generate())
-        labels.append("DiffDiff")
-
-    return trajs, labels
-
+    return [
+        {"T": T_, "dt": dt_, "tau": tau_, "sigma": sigma_}
+        for T_, dt_, tau_, sigma_ in zip(T, dt, tau, sigma)
+    ]
 
-def _build_random_walk(n_trajs: int) -> Tuple[List[Trajectory], List[Any]]:
-    rng = np.random.default_rng(seed)
 
+def _random_walk_params(rng: np.random.Generator, n_trajs: int) -> List[Dict[str, Any]]:
     tau = rng.uniform(*RANG_T_SCALE, size=n_trajs)
     T = tau * rng.uniform(*RANG_T, size=n_trajs)
     dt = tau * rng.uniform(*RANG_DT, size=n_trajs)
     rand_vec = rng.uniform(0, 10, size=(n_trajs, DIM, 3))
     prob = rand_vec / rand_vec.sum(-1)[..., None]
 
-    trajs, labels = [], []
-    for T_, dt_, prob_ in zip(T, dt, prob):
-        rw_gen = RandomWalkGenerator(
-            T=T_, dim=DIM, N=1, dt=dt_, actions_prob=prob_, seed=get_seed()
-        )
-        trajs.append(*rw_gen.generate())
-        labels.append("RandomWalk")
+    return [
+        {"T": T_, "dt": dt_, "actions_prob": prob_}
+        for T_, dt_, prob_ in zip(T, dt, prob)
+    ]
 
-    return trajs, labels
+
+_MODELS: Dict[str, Tuple[type, Callable[[np.random.Generator, int], List[dict]]]] = {
+    "Langevin": (LangevinGenerator, _langevin_params),
+    "RandomWalk": (RandomWalkGenerator, _random_walk_params),
+    "DiffDiff": (DiffDiffGenerator, _diffdiff_params),
+}
 
 
 if __name__ == "__main__":
@@ -1,61 +1,115 @@
-import csv
+import itertools
 import logging
-from datetime import datetime
 from pathlib import Path
-from typing import Any, List, Tuple
+from typing import IO, Iterator, Tuple
 
+import numpy as np
 from yupi import Trajectory
 
+from utils.rawfs import raw_data
+from utils.timestamps import elapsed_seconds, parse_datetimes
 from utils.utils import download_dataset
 
-VERSION = 0
+VERSION = 1
 NAME = "traffic"
 
 _TRAFFIC_URL = (
     "https://zen-traffic-data.net/english/file/archive/TRAJECTORY_PUB_SMP.zip"
 )
 
+_CSV_FILE = "TRAJECTORY_PUB_SMP.csv"
+_TIME_FMT = "%H%M%S%f"
+_MIN_CAR_ROWS = 3
 
-def build() -> Tuple[List[Trajectory], List[Any]]:
-    raw_dir = _fetch_raw_data()
-    return _yupify(raw_dir)
+# Rows read at once from the csv file
+_CHUNK_ROWS = 500_000
+
+# Used columns of the csv file: id, time, type, x and y
+_CSV_COLUMNS = (0, 1, 2, 5, 6)
+# Width of the time field, wider than any valid time so longer values (which
+# np.loadtxt truncates) fail to parse instead of giving wrong timestamps
+_TIME_WIDTH = 32
+_CSV_DTYPE = np.dtype(
+    [
+        ("id", np.int64),
+        ("time", f"U{_TIME_WIDTH}"),
+        ("type", np.int64),
+        ("x", np.float64),
+        ("y", np.float64),
+    ]
+)
+_CHUNK_DTYPE = np.dtype(
+    [
+        ("id", np.int64),
+        ("time", "datetime64[us]"),
+        ("type", np.int64),
+        ("x", np.float64),
+        ("y", np.float64),
+    ]
+)
+
+
+def build() -> Iterator[Tuple[Trajectory, str]]:
+    # The archive is read while the trajectories are consumed
+    with raw_data(_fetch_raw_data()) as raw_dir:
+        yield from _yupify(raw_dir)
 
 
 def _fetch_raw_data() -> Path:
-    raw_trajs_filepath = download_dataset(_TRAFFIC_URL, NAME)
-    return raw_trajs_filepath.parent
+    return download_dataset(_TRAFFIC_URL, NAME)
+
+
+def _read_chunks(csv_file: IO[str]) -> Iterator[np.ndarray]:
+    """Reads the used columns of the csv file in blocks of rows."""
+    while True:
+        lines = list(itertools.islice(csv_file, _CHUNK_ROWS))
+        if not lines:
+            return
+        raw_chunk = np.loadtxt(
+            lines, dtype=_CSV_DTYPE, delimiter=",", usecols=_CSV_COLUMNS, ndmin=1
+        )
+        chunk = np.empty(len(raw_chunk), dtype=_CHUNK_DTYPE)
+        for column in ("id", "type", "x", "y"):
+            chunk[column] = raw_chunk[column]
+        if np.any(np.char.str_len(raw_chunk["time"]) >= _TIME_WIDTH):
+            raise ValueError(
+                f"Time values of {_CSV_FILE} longer than {_TIME_WIDTH - 1} "
+                "characters"
+            )
+        chunk["time"] = parse_datetimes(raw_chunk["time"], _TIME_FMT)
+        yield chunk
+
 
+def _iter_cars(csv_file: IO[str]) -> Iterator[np.ndarray]:
+    """
+    Iterates over the (consecutive) rows of each car.
 
-def _get_time(date_str: str) -> datetime:
-    return datetime.strptime(date_str.strip(), r"%H%M%S%f")
+    The last car of a chunk may continue in the next one, so it is carried
+    over and joined with the next chunk.
+    """
+    carry = np.empty(0, dtype=_CHUNK_DTYPE)
+    for chunk in _read_chunks(csv_file):
+        if len(carry):
+            chunk = np.concatenate((carry, chunk))
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(chunk["id"])) + 1))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield chunk[start:end]
+        carry = chunk[bounds[-1] :]
+    if len(carry):
+        yield carry
 
 
-def _process_car(car_rows: List[List[Any]]) -> Tuple[Trajectory, str]:
-    x = [float(row[5]) for row in car_rows]
-    y = [float(row[6]) for row in car_rows]
-    dt0 = _get_time(car_rows[0][1])
-    t = [(_get_time(row[1]) - dt0).total_seconds() for row in car_rows]
-    label = "normal" if int(car_rows[0][2]) == 1 else "large"
-    traj = Trajectory(x=x, y=y, t=t)
+def _process_car(car_rows: np.ndarray) -> Tuple[Trajectory, str]:
+    t = elapsed_seconds(car_rows["time"])
+    label = "normal" if car_rows["type"][0] == 1 else "large"
+    traj = Trajectory(x=car_rows["x"], y=car_rows["y"], t=t)
     return traj, label
 
 
-def _yupify(raw_dir) -> Tuple[List[Trajectory], List[str]]:
-    # Loads the raw data and preprocess it
+def _yupify(raw_dir) -> Iterator[Tuple[Trajectory, str]]:
+    # Loads the raw data and yields the trajectories one car at a time
     logging.info("Preprocessing Traffic raw data")
-    trajs, labels = [], []
-
-    with open(raw_dir / "TRAJECTORY_PUB_SMP.csv", "r") as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=",")
-        current_car = [next(csv_reader)]
-        current_id = current_car[0][0]
-        for row in csv_reader:
-            if row[0] != current_id:
-                if len(current_car) > 2:
-                    traj, label = _process_car(current_car)
-                    trajs.append(traj)
-                    labels.append(label)
-                current_car = []
-                current_id = row[0]
-            current_car.append(row)
-    return trajs, labels
+    with (raw_dir / _CSV_FILE).open("r") as csv_file:
+        for car_rows in _iter_cars(csv_file):
+            if len(car_rows) >= _MIN_CAR_ROWS:
+                yield _process_car(car_rows)
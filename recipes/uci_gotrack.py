@@ -1,12 +1,13 @@
 import csv
 import logging
-from datetime import datetime
 from pathlib import Path
 from typing import Any, Dict, List, Tuple, Union
 
+import numpy as np
 from yupi import Trajectory
 
 import config as cfg
+from utils.timestamps import elapsed_seconds, parse_datetimes
 from utils.utils import _get_path, download_dataset
 
 VERSION = 0
@@ -29,18 +30,16 @@ def _fetch_raw_data() -> Path:
 
 
 def _get_traj(rows: List[dict]) -> Union[Trajectory, None]:
-    lat, lon, time = [], [], []
-    _t0 = datetime.strptime(rows[0]["time"], "%Y-%m-%d %H:%M:%S")
-    _last_t = None
-    for row in rows:
-        _t = datetime.strptime(row["time"], "%Y-%m-%d %H:%M:%S")
-        if _last_t is not None and _t <= _last_t:
-            _last_t = _t
-            continue
-        lat.append(float(row["latitude"]))
-        lon.append(float(row["longitude"]))
-        time.append((_t - _t0).total_seconds())
-        _last_t = _t
+    times = parse_datetimes([row["time"] for row in rows], "%Y-%m-%d %H:%M:%S")
+
+    # Skip the rows that are not after the previous one
+    keep = np.ones(len(times), dtype=bool)
+    keep[1:] = times[1:] > times[:-1]
+    kept_rows = [row for row, keep_row in zip(rows, keep) if keep_row]
+
+    lat = [float(row["latitude"]) for row in kept_rows]
+    lon = [float(row["longitude"]) for row in kept_rows]
+    time = elapsed_seconds(times)[keep]
     return Trajectory(x=lon, y=lat, t=time) if len(time) > 3 else None
 
 
@@ -5,7 +5,7 @@ from typing import Any, List, Tuple
 
 from yupi import Trajectory
 
-from utils.utils import download_dataset
+from utils.utils import download_datasets
 
 VERSION = 0
 NAME = "uci_pen_digits"
@@ -25,8 +25,9 @@ def build() -> Tuple[List[Trajectory], List[Any]]:
 
 
 def _fetch_raw_data() -> Path:
-    download_dataset(_UCI_PEN_TEST, NAME, uncompress=False)
-    raw_trajs_filepath = download_dataset(_UCI_PEN_TRAIN, NAME, uncompress=False)
+    _, raw_trajs_filepath = download_datasets(
+        [_UCI_PEN_TEST, _UCI_PEN_TRAIN], NAME, uncompress=False
+    )
     return raw_trajs_filepath.parent
 
 
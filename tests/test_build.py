@@ -0,0 +1,51 @@
+"""
+Tests of the build of a recipe into its outputs.
+
+Run them from the repository root with ``python -m pytest tests``.
+"""
+
+import json
+
+import numpy as np
+import pytest
+from yupi import Trajectory
+
+import build
+from utils.compression import open_input
+from utils.summary import SUMMARY_EXTENSION, read_summary
+
+NAME = "mixed"
+LABELS = [5, "a", None, 2.5]
+
+
+def _mixed_labels_recipe():
+    for i, label in enumerate(LABELS):
+        traj = Trajectory(x=np.arange(3.0) + i, y=np.arange(3.0), dt=1.0)
+        yield traj, label
+
+
+def _read_main_output(output_dir):
+    with open_input(output_dir / f"{NAME}.zip") as yupi_file:
+        return json.load(yupi_file)
+
+
+def test_mixed_labels_summary(tmp_path):
+    build._build_recipe(tmp_path, NAME, 1, _mixed_labels_recipe)
+
+    assert _read_main_output(tmp_path)["labels"] == LABELS
+    summary = read_summary(tmp_path / f"{NAME}{SUMMARY_EXTENSION}")
+    assert summary.labels_json
+    assert [json.loads(label) for label in summary.labels] == LABELS
+    assert summary.n_points.tolist() == [3] * len(LABELS)
+
+
+def test_failed_output_keeps_previous_build(tmp_path):
+    build._build_recipe(tmp_path, NAME, 1, _mixed_labels_recipe)
+    previous = _read_main_output(tmp_path)
+
+    # Mixed labels can not be stored in the columnar layout
+    with pytest.raises(ValueError):
+        build._build_recipe(
+            tmp_path, NAME, 2, _mixed_labels_recipe, build.BuildOptions(binary=True)
+        )
+    assert _read_main_output(tmp_path) == previous
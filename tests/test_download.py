@@ -0,0 +1,207 @@
+"""
+Tests of the dataset downloads against a local http server.
+
+Run them from the repository root with ``python -m pytest tests``.
+"""
+
+import hashlib
+import http.server
+import re
+import threading
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+
+import config
+from utils import utils
+
+FILE_NAME = "data.bin"
+
+
+class _RemoteFile:
+    """Content served by the test server, and the requests it got."""
+
+    def __init__(self, content: bytes):
+        self.requests: List[Dict[str, str]] = []
+        self.fail_status = None
+        self.truncate_at = None
+        # Like hosts that ignore If-Modified-Since and send no ETag
+        self.use_etag = True
+        self.last_modified = "Wed, 21 Oct 2015 07:28:00 GMT"
+        self.set_content(content)
+
+    def set_content(self, content: bytes):
+        self.content = content
+        self.etag = f'"{hashlib.sha256(content).hexdigest()[:16]}"'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    remote: _RemoteFile
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        self._respond(head=True)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self._respond(head=False)
+
+    def _respond(self, head: bool):
+        remote = self.remote
+        remote.requests.append({"method": self.command, **dict(self.headers)})
+        if remote.fail_status is not None:
+            self.send_response(remote.fail_status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if remote.use_etag and self.headers.get("If-None-Match") == remote.etag:
+            self.send_response(304)
+            self.send_header("ETag", remote.etag)
+            self.end_headers()
+            return
+
+        content = remote.content
+        start = 0
+        range_match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        if range_match and (if_range is None or if_range == remote.etag):
+            start = int(range_match.group(1))
+            if start >= len(content):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(content)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}"
+            )
+        else:
+            self.send_response(200)
+        if remote.use_etag:
+            self.send_header("ETag", remote.etag)
+        self.send_header("Last-Modified", remote.last_modified)
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        if head:
+            return
+
+        body = content[start:]
+        if remote.truncate_at is not None:
+            # Connection lost in the middle of the transfer
+            body = body[: remote.truncate_at]
+            remote.truncate_at = None
+            self.close_connection = True
+        self.wfile.write(body)
+
+
+@pytest.fixture(name="remote")
+def fixture_remote():
+    remote = _RemoteFile(bytes(range(256)) * 4096)
+    handler = type("Handler", (_Handler,), {"remote": remote})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    remote.url = f"http://127.0.0.1:{server.server_address[1]}/{FILE_NAME}"
+    yield remote
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(name="cache_dir", autouse=True)
+def fixture_cache_dir(tmp_path: Path, monkeypatch):
+    ds_dir = str(tmp_path / "datasets" / "{0}")
+    monkeypatch.setattr(config, "DS_DIR", ds_dir)
+    monkeypatch.setattr(config, "DS_RAW_DIR", ds_dir + "/raw_data")
+    return tmp_path
+
+
+def _download(remote: _RemoteFile) -> Path:
+    return utils.download_dataset(remote.url, "test", uncompress=False)
+
+
+def _interrupted_download(remote: _RemoteFile, sent: int) -> Path:
+    remote.truncate_at = sent
+    with pytest.raises(Exception):
+        _download(remote)
+    part_path = utils._part_path(utils._get_path(config.DS_RAW_DIR, "test") / FILE_NAME)
+    # The last (incomplete) chunk may not be written
+    assert 0 < part_path.stat().st_size <= sent
+    return part_path
+
+
+def test_fresh_download(remote):
+    path = _download(remote)
+    assert path.read_bytes() == remote.content
+    entry = utils._get_download_entry("test", FILE_NAME)
+    assert entry["etag"] == remote.etag
+    assert entry["sha256"] == hashlib.sha256(remote.content).hexdigest()
+
+
+def test_not_modified(remote):
+    path = _download(remote)
+    mtime_ns = path.stat().st_mtime_ns
+    remote.requests.clear()
+
+    assert _download(remote) == path
+    assert [req.get("If-None-Match") for req in remote.requests] == [remote.etag]
+    assert path.stat().st_mtime_ns == mtime_ns
+
+
+def test_not_modified_without_etag(remote):
+    remote.use_etag = False
+    path = _download(remote)
+    mtime_ns = path.stat().st_mtime_ns
+    remote.requests.clear()
+
+    assert _download(remote) == path
+    (request,) = remote.requests
+    assert request["If-Modified-Since"] == remote.last_modified
+    assert path.stat().st_mtime_ns == mtime_ns
+
+    remote.set_content(bytes(reversed(range(256))) * 4096)
+    remote.last_modified = "Thu, 22 Oct 2015 07:28:00 GMT"
+    assert _download(remote).read_bytes() == remote.content
+
+
+def test_unconditional_not_modified_is_an_error(remote):
+    remote.fail_status = 304
+    with pytest.raises(utils.DownloadError):
+        _download(remote)
+
+
+def test_resume(remote):
+    part_path = _interrupted_download(remote, 100_000)
+    downloaded = part_path.stat().st_size
+    remote.requests.clear()
+
+    path = _download(remote)
+    assert path.read_bytes() == remote.content
+    assert not part_path.exists()
+    (request,) = remote.requests
+    assert request["Range"] == f"bytes={downloaded}-"
+    assert request["If-Range"] == remote.etag
+
+
+def test_resume_changed_remote(remote):
+    _interrupted_download(remote, 100_000)
+    remote.set_content(bytes(reversed(range(256))) * 4096)
+
+    path = _download(remote)
+    assert path.read_bytes() == remote.content
+    assert utils._get_download_entry("test", FILE_NAME)["etag"] == remote.etag
+
+
+def test_resume_transient_error_keeps_partial_download(remote):
+    part_path = _interrupted_download(remote, 100_000)
+    downloaded = part_path.stat().st_size
+    remote.fail_status = 503
+    with pytest.raises(utils.DownloadError):
+        _download(remote)
+    assert part_path.stat().st_size == downloaded
+
+    remote.fail_status = None
+    assert _download(remote).read_bytes() == remote.content
@@ -0,0 +1,257 @@
+"""
+Columnar binary layout of a dataset.
+
+All the trajectories of a dataset are stored in a single uncompressed ``.npz``
+file with the following arrays:
+
+- ``r``: positions of every point, concatenated (shape ``(n_points, dim)``)
+- ``t``: time of every point, concatenated (shape ``(n_points,)``)
+- ``offsets``: int64 boundaries of each trajectory inside ``r`` and ``t``
+  (shape ``(n_trajs + 1,)``). Trajectory ``i`` spans
+  ``offsets[i]:offsets[i + 1]``.
+- ``labels``: label of each trajectory (shape ``(n_trajs,)``). Labels must all
+  be of the same type, so they are stored as they are in the json output.
+- ``version``: version of the dataset
+
+The members are not compressed so they can be read (or memory-mapped) without
+any decoding step.
+"""
+
+import numbers
+import shutil
+import tempfile
+import zipfile
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from yupi import Trajectory
+
+COLUMNAR_EXTENSION = ".npz"
+
+# Size of the fixed part of a zip local file header
+_ZIP_LOCAL_HEADER_SIZE = 30
+
+
+class ColumnarData(NamedTuple):
+    """Arrays of a dataset stored in the columnar layout."""
+
+    r: np.ndarray
+    t: np.ndarray
+    offsets: np.ndarray
+    labels: np.ndarray
+    version: int
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def traj(self, index: int) -> Trajectory:
+        """Creates the trajectory at the given index."""
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return Trajectory(
+            points=self.r[start:end], t=self.t[start:end], traj_id=str(index)
+        )
+
+
+def json_traj_arrays(traj_json: Dict[str, Any]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Positions and times of a trajectory serialized by yupi's ``JSONSerializer``,
+    without creating the trajectory.
+    """
+    axes = traj_json.get("axes")
+    if axes is None:
+        # Old yupi format
+        axes = list(traj_json["r"].values())
+    r = np.asarray(axes, dtype=np.float64).T
+    if traj_json.get("t") is not None:
+        t = np.asarray(traj_json["t"], dtype=np.float64)
+    else:
+        # Same as Trajectory.t for uniformly sampled trajectories
+        t = traj_json.get("t_0", 0.0) + traj_json["dt"] * np.arange(
+            len(r), dtype=np.float64
+        )
+    return r, t
+
+
+def _label_kind(label: Any) -> str:
+    if isinstance(label, str):
+        return "str"
+    if isinstance(label, (bool, np.bool_)):
+        return "bool"
+    if isinstance(label, numbers.Integral):
+        return "int"
+    if isinstance(label, numbers.Real):
+        return "float"
+    return type(label).__name__
+
+
+def labels_array(labels: List[Any]) -> np.ndarray:
+    """
+    Array of the labels of a dataset.
+
+    Labels must all be of the same kind (strings, integers, floats...), since
+    numpy would otherwise convert them (e.g. the label ``5`` into ``'5'``) and
+    they would not round-trip to the json output.
+    """
+    kinds = {_label_kind(label) for label in labels}
+    if len(kinds) > 1:
+        raise ValueError(
+            f"All labels must be of the same type, got: {', '.join(sorted(kinds))}"
+        )
+    labels_arr = np.asarray(labels)
+    if labels_arr.dtype == object:
+        raise ValueError("Labels can not be stored as a (non object) numpy array")
+    return labels_arr
+
+
+class ColumnarWriter:
+    """
+    Writes a dataset in the columnar layout one trajectory at a time.
+
+    Points are spilled to temporary files (next to the output file) as the
+    trajectories are added, and only joined into the ``.npz`` file when the
+    writer is closed, so memory does not grow with the dataset size. Used as
+    a context manager, nothing is written if an exception is raised.
+    """
+
+    def __init__(self, path: Path, version: int):
+        self.path = path
+        self.version = version
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._tmp_dir = Path(tempfile.mkdtemp(prefix=".columnar-", dir=path.parent))
+        self._r_file = open(self._tmp_dir / "r.bin", "wb")
+        self._t_file = open(self._tmp_dir / "t.bin", "wb")
+        self._lengths: List[int] = []
+        self._labels: List[Any] = []
+        self._dim: Optional[int] = None
+        self._closed = False
+
+    def add(self, traj: Trajectory, label: Any):
+        """Adds a trajectory (and its label)."""
+        self.add_arrays(traj.r, traj.t, label)
+
+    def add_arrays(self, r: np.ndarray, t: np.ndarray, label: Any):
+        """Adds a trajectory given its positions and times (and its label)."""
+        r = np.asarray(r, dtype=np.float64)
+        dim = r.shape[1]
+        if self._dim is None:
+            self._dim = dim
+        elif dim != self._dim:
+            raise ValueError(
+                f"All trajectories must have the same dimension. "
+                f"Got {dim}, expected {self._dim}."
+            )
+        r.tofile(self._r_file)
+        np.asarray(t, dtype=np.float64).tofile(self._t_file)
+        self._lengths.append(len(r))
+        self._labels.append(label)
+
+    def close(self) -> Path:
+        """Writes the ``.npz`` file with every added trajectory."""
+        if self._closed:
+            return self.path
+        try:
+            self._r_file.close()
+            self._t_file.close()
+            offsets = np.zeros(len(self._lengths) + 1, dtype=np.int64)
+            np.cumsum(self._lengths, out=offsets[1:])
+            dim = 0 if self._dim is None else self._dim
+
+            with open(self.path, "wb") as columnar_file:
+                np.savez(
+                    columnar_file,
+                    r=self._spilled("r.bin", (offsets[-1], dim)),
+                    t=self._spilled("t.bin", (offsets[-1],)),
+                    offsets=offsets,
+                    labels=labels_array(self._labels),
+                    version=np.int64(self.version),
+                )
+        finally:
+            self.discard()
+        return self.path
+
+    def discard(self):
+        """Removes the spilled data without writing the ``.npz`` file."""
+        self._closed = True
+        self._r_file.close()
+        self._t_file.close()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def _spilled(self, file_name: str, shape: tuple) -> np.ndarray:
+        if 0 in shape:
+            return np.empty(shape, dtype=np.float64)
+        return np.memmap(
+            self._tmp_dir / file_name, dtype=np.float64, mode="r", shape=shape
+        )
+
+    def __enter__(self) -> "ColumnarWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def _member_data_offset(npz_file, info: zipfile.ZipInfo) -> int:
+    """Returns the position of the first byte of a stored zip member."""
+    npz_file.seek(info.header_offset)
+    header = npz_file.read(_ZIP_LOCAL_HEADER_SIZE)
+    name_len = int.from_bytes(header[26:28], "little")
+    extra_len = int.from_bytes(header[28:30], "little")
+    return info.header_offset + _ZIP_LOCAL_HEADER_SIZE + name_len + extra_len
+
+
+def _mmap_npz(path: Path) -> Dict[str, np.ndarray]:
+    """Memory-maps every (uncompressed) array of a npz file."""
+    arrays = {}
+    with zipfile.ZipFile(path) as npz_zip, open(path, "rb") as npz_file:
+        for info in npz_zip.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"Member '{info.filename}' of {path} is compressed")
+
+            data_offset = _member_data_offset(npz_file, info)
+            npz_file.seek(data_offset)
+            if np.lib.format.read_magic(npz_file) == (1, 0):
+                header = np.lib.format.read_array_header_1_0(npz_file)
+            else:
+                header = np.lib.format.read_array_header_2_0(npz_file)
+            shape, fortran_order, dtype = header
+            name = info.filename[: -len(".npy")]
+            if not shape or 0 in shape:
+                # Scalars and empty arrays can not be memory-mapped
+                npz_file.seek(data_offset)
+                arrays[name] = np.lib.format.read_array(npz_file)
+                continue
+            arrays[name] = np.memmap(
+                path,
+                dtype=dtype,
+                mode="r",
+                offset=npz_file.tell(),
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+    return arrays
+
+
+def load_columnar(path: Path, mmap: bool = False) -> ColumnarData:
+    """
+    Loads all the arrays of a dataset stored in the columnar layout.
+
+    If ``mmap`` is True the arrays are memory-mapped instead of read, so
+    opening the dataset takes the same time regardless of its size.
+    """
+    if mmap:
+        data = _mmap_npz(path)
+    else:
+        with np.load(path, allow_pickle=False) as npz_data:
+            data = dict(npz_data.items())
+
+    return ColumnarData(
+        r=data["r"],
+        t=data["t"],
+        offsets=data["offsets"],
+        labels=data["labels"],
+        version=int(data["version"]),
+    )
@@ -0,0 +1,217 @@
+"""
+Output codecs of the built datasets.
+
+A codec is given as ``name[:level]`` (e.g. ``deflate:9``):
+
+- ``deflate`` (default), ``bzip2``, ``lzma`` and ``store``: a ``.zip``
+  archive with the json data as its only member.
+- ``zstd``: a zstandard compressed ``.json.zst`` file, compressed with one
+  thread per cpu. It requires the optional ``zstandard`` package.
+
+The json data is written straight into the output file as it is serialized,
+and compressed in a background thread (all the codecs release the GIL while
+compressing), so serialization and compression run in parallel.
+"""
+
+import contextlib
+import io
+import queue
+import threading
+import zipfile
+from pathlib import Path
+from typing import IO, Iterator, NamedTuple, Optional
+
+DEFAULT_CODEC = "deflate"
+
+_ZIP_METHODS = {
+    "store": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+}
+
+# Valid compression levels of the codecs that have them
+_LEVELS = {"deflate": (0, 9), "bzip2": (1, 9), "zstd": (1, 22)}
+
+ZSTD_EXTENSION = ".json.zst"
+ZIP_EXTENSION = ".zip"
+
+CODECS = sorted([*_ZIP_METHODS, "zstd"])
+
+# Size of the chunks handed to the compression thread
+_CHUNK_SIZE = 2**20
+_MAX_PENDING_CHUNKS = 8
+
+
+class Codec(NamedTuple):
+    """Compression codec (and level) of a dataset output file."""
+
+    name: str
+    level: Optional[int] = None
+
+    @property
+    def extension(self) -> str:
+        """Extension of the output file"""
+        return ZSTD_EXTENSION if self.name == "zstd" else ZIP_EXTENSION
+
+    def __str__(self) -> str:
+        return self.name if self.level is None else f"{self.name}:{self.level}"
+
+
+def parse_codec(spec: str) -> Codec:
+    """Parses a ``name[:level]`` codec specification."""
+    name, _, level_str = spec.partition(":")
+    name = name.strip().lower()
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec '{name}'. Valid codecs: {', '.join(CODECS)}")
+    if not level_str:
+        return Codec(name)
+
+    if name not in _LEVELS:
+        raise ValueError(f"Codec '{name}' has no compression levels")
+    low, high = _LEVELS[name]
+    try:
+        level = int(level_str)
+    except ValueError as err:
+        raise ValueError(f"Invalid compression level '{level_str}'") from err
+    if not low <= level <= high:
+        raise ValueError(f"Codec '{name}' levels go from {low} to {high}")
+    return Codec(name, level)
+
+
+def check_codec(codec: Codec):
+    """Raises an ImportError if the optional package of a codec is missing."""
+    if codec.name == "zstd":
+        _import_zstd()
+
+
+def _import_zstd():
+    try:
+        import zstandard  # pylint: disable=import-outside-toplevel
+    except ImportError as err:
+        raise ImportError(
+            "The zstd codec requires the zstandard package (pip install zstandard)"
+        ) from err
+    return zstandard
+
+
+class _ThreadedSink(io.RawIOBase):
+    """Binary stream that writes into another one from a background thread."""
+
+    def __init__(self, stream: IO[bytes]):
+        super().__init__()
+        self._stream = stream
+        self._chunks: "queue.Queue[Optional[bytes]]" = queue.Queue(_MAX_PENDING_CHUNKS)
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                return
+            # After an error keep draining the queue, so writers never block
+            if self._error is None:
+                try:
+                    self._stream.write(chunk)
+                except BaseException as err:  # pylint: disable=broad-except
+                    self._error = err
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:  # type: ignore[override]
+        self._check_error()
+        chunk = bytes(data)
+        self._chunks.put(chunk)
+        return len(chunk)
+
+    def close(self):
+        if not self.closed:
+            self._chunks.put(None)
+            self._thread.join()
+            super().close()
+            self._check_error()
+
+
+@contextlib.contextmanager
+def _open_binary(path: Path, member_name: str, codec: Codec) -> Iterator[IO[bytes]]:
+    if codec.name == "zstd":
+        zstd = _import_zstd()
+        level = 3 if codec.level is None else codec.level
+        compressor = zstd.ZstdCompressor(level=level, threads=-1)
+        with open(path, "wb") as raw_file, compressor.stream_writer(
+            raw_file, closefd=False
+        ) as zstd_file:
+            yield zstd_file
+        return
+
+    with zipfile.ZipFile(
+        path, "w", _ZIP_METHODS[codec.name], compresslevel=codec.level
+    ) as zip_file, zip_file.open(member_name, "w", force_zip64=True) as member:
+        yield member
+
+
+@contextlib.contextmanager
+def open_binary_output(
+    path: Path, member_name: str, codec: Codec
+) -> Iterator[IO[bytes]]:
+    """Same as ``open_output``, for data that is already utf-8 encoded."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    try:
+        with _open_binary(tmp_path, member_name, codec) as binary_file:
+            buffer = io.BufferedWriter(_ThreadedSink(binary_file), _CHUNK_SIZE)
+            try:
+                yield buffer
+            finally:
+                # Waits for the pending chunks (leaves binary_file open)
+                buffer.close()
+        tmp_path.replace(path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+@contextlib.contextmanager
+def open_output(path: Path, member_name: str, codec: Codec) -> Iterator[IO[str]]:
+    """
+    Opens a text stream that writes compressed into the output file of a
+    dataset (as ``member_name`` inside zip archives).
+
+    The data is written to a temporary file that only replaces ``path`` once
+    it is complete, so a failed build keeps the previous output.
+    """
+    with open_binary_output(path, member_name, codec) as buffer:
+        text_file = io.TextIOWrapper(buffer, encoding="utf-8")
+        try:
+            yield text_file
+        finally:
+            text_file.detach()
+
+
+@contextlib.contextmanager
+def open_input(path: Path) -> Iterator[IO[bytes]]:
+    """
+    Opens the (decompressed) json data of an output file written with any of
+    the codecs.
+    """
+    if path.name.endswith(ZSTD_EXTENSION):
+        zstd = _import_zstd()
+        with open(path, "rb") as raw_file, zstd.ZstdDecompressor().stream_reader(
+            raw_file
+        ) as zstd_file:
+            yield zstd_file
+        return
+
+    with zipfile.ZipFile(path) as zip_file:
+        members = zip_file.namelist()
+        if len(members) != 1:
+            raise ValueError(f"Expected a single json member in {path}")
+        with zip_file.open(members[0]) as member:
+            yield member
@@ -0,0 +1,196 @@
+"""
+Per-stage timing and memory instrumentation of the builds.
+
+A ``RecipeReport`` is active while a recipe is built (``recipe_report``) and
+every ``stage`` entered meanwhile adds its wall time to it. Stages can be
+nested, and are keyed by their path (e.g. ``build/download``), so the time of
+a stage includes the time of its sub-stages. Stages entered several times
+(e.g. once per trajectory) are accumulated.
+
+If memory tracing is enabled, stages also record the peak of the memory
+allocated (by Python, as seen by ``tracemalloc``) since the stage started.
+Memory is only probed in the main thread, and stages can opt out of it
+(``memory=False``) when they are entered too often for it to be cheap. On
+Python 3.8 ``tracemalloc`` peaks can not be reset, so nested stages may
+report the peak of a previous stage.
+"""
+
+import contextlib
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+_MB = 1024**2
+
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+_CURRENT_REPORT: Optional["RecipeReport"] = None
+
+
+class RecipeReport:
+    """Stages, trajectories and points of a recipe build."""
+
+    def __init__(self, name: str, trace_memory: bool = False):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.trajs = 0
+        self.points = 0
+        self.wall_s = 0.0
+        self.peak_mb: Optional[float] = None
+
+    def add_stage(self, key: str, wall_s: float, peak_mb: Optional[float] = None):
+        """Adds a (possibly repeated) run of a stage."""
+        with _LOCK:
+            stage = self.stages.setdefault(
+                key, {"wall_s": 0.0, "calls": 0, "peak_mb": None}
+            )
+            stage["wall_s"] += wall_s
+            stage["calls"] += 1
+            if peak_mb is not None:
+                stage["peak_mb"] = max(stage["peak_mb"] or 0.0, peak_mb)
+
+    def add_traj(self, n_points: int):
+        """Counts a trajectory of the dataset."""
+        with _LOCK:
+            self.trajs += 1
+            self.points += n_points
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Report as a json-compatible dict."""
+        return {
+            "wall_s": self.wall_s,
+            "peak_mb": self.peak_mb,
+            "trajs": self.trajs,
+            "points": self.points,
+            "stages": self.stages,
+        }
+
+
+class _MemoryFrame:
+    """Memory probe of a stage (see ``_enter_memory`` / ``_exit_memory``)."""
+
+    def __init__(self, start: int):
+        self.start = start
+        self.peak = start
+
+
+def _stage_stack() -> List[str]:
+    if not hasattr(_LOCAL, "stages"):
+        _LOCAL.stages = []
+    return _LOCAL.stages
+
+
+def _memory_stack() -> List[_MemoryFrame]:
+    if not hasattr(_LOCAL, "memory"):
+        _LOCAL.memory = []
+    return _LOCAL.memory
+
+
+def _reset_peak():
+    # Not available on Python 3.8
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+
+
+def _enter_memory() -> _MemoryFrame:
+    current, peak = tracemalloc.get_traced_memory()
+    frames = _memory_stack()
+    if frames:
+        # The peak since the parent stage started (or since the last reset)
+        frames[-1].peak = max(frames[-1].peak, peak)
+    _reset_peak()
+    frame = _MemoryFrame(current)
+    frames.append(frame)
+    return frame
+
+
+def _exit_memory(frame: _MemoryFrame) -> float:
+    _, peak = tracemalloc.get_traced_memory()
+    frames = _memory_stack()
+    frames.pop()
+    frame.peak = max(frame.peak, peak)
+    if frames:
+        frames[-1].peak = max(frames[-1].peak, frame.peak)
+    _reset_peak()
+    return (frame.peak - frame.start) / _MB
+
+
+def _memory_enabled(report: RecipeReport) -> bool:
+    return (
+        report.trace_memory
+        and tracemalloc.is_tracing()
+        and threading.current_thread() is threading.main_thread()
+    )
+
+
+@contextlib.contextmanager
+def recipe_report(name: str, trace_memory: bool = False) -> Iterator[RecipeReport]:
+    """Makes a new report the target of the stages run inside the context."""
+    global _CURRENT_REPORT  # pylint: disable=global-statement
+
+    report = RecipeReport(name, trace_memory)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    frame = _enter_memory() if _memory_enabled(report) else None
+    prev_report, _CURRENT_REPORT = _CURRENT_REPORT, report
+    start = time.perf_counter()
+    try:
+        yield report
+    finally:
+        report.wall_s = time.perf_counter() - start
+        _CURRENT_REPORT = prev_report
+        if frame is not None:
+            report.peak_mb = _exit_memory(frame)
+        if started_tracing:
+            tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def stage(name: str, memory: bool = True) -> Iterator[None]:
+    """
+    Times (and probes the memory of) a build stage of the current recipe.
+    Does nothing if no recipe report is active.
+    """
+    report = _CURRENT_REPORT
+    if report is None:
+        yield
+        return
+
+    stages = _stage_stack()
+    stages.append(name)
+    key = "/".join(stages)
+    frame = _enter_memory() if memory and _memory_enabled(report) else None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall_s = time.perf_counter() - start
+        peak_mb = _exit_memory(frame) if frame is not None else None
+        stages.pop()
+        report.add_stage(key, wall_s, peak_mb)
+
+
+def timed_iter(iterable: Iterable[T], name: str) -> Iterator[T]:
+    """
+    Iterates over ``iterable`` accumulating the time spent producing each
+    item into a stage (e.g. a recipe generator consumed while serializing).
+    """
+    iterator = iter(iterable)
+    while True:
+        with stage(name, memory=False):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def count_traj(n_points: int):
+    """Counts a trajectory (and its points) in the current recipe report."""
+    if _CURRENT_REPORT is not None:
+        _CURRENT_REPORT.add_traj(n_points)
@@ -0,0 +1,62 @@
+"""
+Label-partitioned json output of a dataset.
+
+The trajectories are grouped by label, one file per label (in order of first
+appearance), so loading some classes only reads (and decompresses) their
+files. Each file is a regular dataset json (``version``, ``trajs`` and
+``labels``) compressed with the build codec, and trajectories keep their
+dataset-wide ids. Files are written inside a ``<name>-by-label`` folder:
+
+- ``<name>-label-<i><ext>``: the trajectories of the ``i``-th label
+- ``index.json``: the codec and totals of the dataset, and for each label
+  its file, ``[start, end)`` range in the label-partitioned order, number of
+  points, size in bytes (compressed and of the json) and the sha256 of its
+  json (see ``utils/shards.py``).
+"""
+
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from utils.compression import Codec
+from utils.shards import Group, GroupedJsonWriter
+
+LABELS_DIR_SUFFIX = "-by-label"
+
+
+def labels_dir(output_dir: Path, name: str) -> Path:
+    """Folder with the label partitions (and index) of a dataset."""
+    return output_dir / f"{name}{LABELS_DIR_SUFFIX}"
+
+
+class LabelPartitionWriter(GroupedJsonWriter):
+    """Writes a dataset as one json file per label."""
+
+    GROUPS_KEY = "labels"
+
+    def __init__(self, output_dir: Path, name: str, version: int, codec: Codec):
+        super().__init__(labels_dir(output_dir, name), name, version, codec)
+
+    def _groups(self) -> List[Group]:
+        # Labels are grouped by their json, so any json label can be used
+        trajs_by_label: Dict[str, List[int]] = {}
+        for i, label in enumerate(self._labels):
+            trajs_by_label.setdefault(self._encode(label), []).append(i)
+
+        groups = []
+        start = 0
+        for label_idx, indices in enumerate(trajs_by_label.values()):
+            end = start + len(indices)
+            groups.append(
+                (
+                    f"{self.name}-label-{label_idx:05d}{self.codec.extension}",
+                    np.asarray(indices, dtype=np.int64),
+                    {"label": self._labels[indices[0]], "trajs": [start, end]},
+                )
+            )
+            start = end
+        return groups
+
+    def _files_glob(self) -> str:
+        return f"{self.name}-label-*"
@@ -0,0 +1,158 @@
+"""
+Build manifests.
+
+A build manifest is a small json file stored next to the cached dataset that
+records, for each build folder, everything the last build there depended on:
+the recipe version, a fingerprint of the recipe and shared code, the build
+options (including the optional outputs), the raw input files and the size
+and mtime of every produced artifact. Comparing it with the current state
+tells whether a rebuild is needed without reading the (large) dataset itself.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+_HASH_CHUNK_SIZE = 1024**2
+
+MANIFEST_FILE_NAME = "build_manifest.json"
+
+# Unfinished downloads are not inputs of a build
+_IGNORED_INPUT_SUFFIXES = (".part",)
+
+
+def file_sha256(path: Path) -> str:
+    """Computes the sha256 hex digest of a file."""
+    sha = hashlib.sha256()
+    with open(path, "rb") as _fd:
+        for chunk in iter(lambda: _fd.read(_HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def code_fingerprint(paths: Iterable[Path]) -> str:
+    """Computes a single sha256 digest of the content of several files."""
+    sha = hashlib.sha256()
+    for path in sorted(paths):
+        sha.update(path.name.encode("utf-8"))
+        sha.update(path.read_bytes())
+    return sha.hexdigest()
+
+
+def _input_files(raw_dir: Path) -> Dict[str, Path]:
+    return {
+        path.name: path
+        for path in sorted(raw_dir.iterdir())
+        if path.is_file() and path.suffix not in _IGNORED_INPUT_SUFFIXES
+    }
+
+
+def inputs_fingerprint(
+    raw_dir: Path, previous: Optional[Dict[str, dict]] = None
+) -> Dict[str, dict]:
+    """
+    Fingerprints (size, mtime and sha256) the raw input files of a dataset.
+
+    Only the files directly inside ``raw_dir`` are considered: those are the
+    downloaded files, while folders hold their extracted content.
+
+    Files whose size and mtime match the ``previous`` fingerprint are not
+    hashed again.
+    """
+    previous = {} if previous is None else previous
+    inputs: Dict[str, dict] = {}
+    if not raw_dir.exists():
+        return inputs
+
+    for path in _input_files(raw_dir).values():
+        stat = path.stat()
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        prev_entry = previous.get(path.name, {})
+        if all(prev_entry.get(key) == val for key, val in entry.items()):
+            entry["sha256"] = prev_entry["sha256"]
+        else:
+            entry["sha256"] = file_sha256(path)
+        inputs[path.name] = entry
+    return inputs
+
+
+def inputs_changed(raw_dir: Path, previous: Dict[str, dict]) -> bool:
+    """
+    Checks if the raw input files differ from a previous fingerprint.
+
+    Files are only hashed when their size is the same but their mtime is not.
+    """
+    if not raw_dir.exists():
+        return bool(previous)
+
+    current = _input_files(raw_dir)
+    if current.keys() != previous.keys():
+        return True
+
+    for file_name, path in current.items():
+        stat = path.stat()
+        prev_entry = previous[file_name]
+        if stat.st_size != prev_entry["size"]:
+            return True
+        if stat.st_mtime_ns != prev_entry["mtime_ns"]:
+            if file_sha256(path) != prev_entry["sha256"]:
+                return True
+    return False
+
+
+def outputs_fingerprint(output_dir: Path, paths: Iterable[Path]) -> Dict[str, dict]:
+    """
+    Fingerprints (size and mtime) the output files of a build, keyed by their
+    path relative to ``output_dir``.
+    """
+    outputs: Dict[str, dict] = {}
+    for path in paths:
+        stat = path.stat()
+        outputs[path.relative_to(output_dir).as_posix()] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+    return outputs
+
+
+def outputs_changed(output_dir: Path, previous: Dict[str, dict]) -> bool:
+    """Checks if any output file is missing or differs from its fingerprint."""
+    for rel_path, prev_entry in previous.items():
+        try:
+            stat = (output_dir / rel_path).stat()
+        except OSError:
+            return True
+        if (stat.st_size, stat.st_mtime_ns) != (
+            prev_entry["size"],
+            prev_entry["mtime_ns"],
+        ):
+            return True
+    return False
+
+
+def load_manifest(path: Path) -> Optional[Dict[str, Any]]:
+    """Loads a build manifest. Returns None if there is no valid manifest."""
+    if not path.exists():
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as manifest_file:
+            return json.load(manifest_file)
+    except json.JSONDecodeError:
+        return None
+
+
+def save_manifest(path: Path, manifest: Dict[str, Any]):
+    """Saves a build manifest (atomically, even if several processes do it)."""
+    tmp_fd, tmp_name = tempfile.mkstemp(
+        prefix=f".{path.name}.", suffix=".tmp", dir=path.parent
+    )
+    try:
+        with os.fdopen(tmp_fd, "w", encoding="utf-8") as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+        os.replace(tmp_name, path)
+    finally:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
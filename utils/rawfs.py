@@ -0,0 +1,268 @@
+"""
+Read-only access to the raw data of a dataset without extracting archives.
+
+``open_raw`` returns an object with a (small) ``pathlib.Path``-like interface
+(``/``, ``name``, ``iterdir``, ``glob``, ``exists``, ``is_dir``, ``is_file``,
+``stat`` and ``open``) for a folder, a ``.zip`` file or a tar archive, so
+recipes can read the members of an archive as streams in the same way they
+would read extracted files.
+
+Members of zip files can be opened in any order. Tar archives (and
+specially compressed ones) are only cheap to read in archive order, so
+``iter_members`` should be preferred to read all their files.
+
+Archives stay open until they are closed (``ArchivePath.close``, or using
+``raw_data`` as a context manager).
+"""
+
+import abc
+import contextlib
+import fnmatch
+import io
+import posixpath
+import tarfile
+import time
+import zipfile
+from pathlib import Path
+from typing import IO, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+
+_TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+
+class MemberStat(NamedTuple):
+    """Size and modification time of an archive member"""
+
+    st_size: int
+    st_mtime: float
+
+
+class _ArchiveIndex(abc.ABC):
+    """Files and folders of an archive."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.files: Dict[str, MemberStat] = {}
+        self.dirs: Dict[str, Set[str]] = {"": set()}
+
+    def _add_file(self, name: str, stat: MemberStat):
+        name = name.strip("/")
+        self.files[name] = stat
+        self._add_dir(posixpath.dirname(name))
+        self.dirs[posixpath.dirname(name)].add(posixpath.basename(name))
+
+    def _add_dir(self, name: str):
+        name = name.strip("/")
+        if name not in self.dirs:
+            self.dirs[name] = set()
+            parent = posixpath.dirname(name)
+            self._add_dir(parent)
+            self.dirs[parent].add(posixpath.basename(name))
+
+    @abc.abstractmethod
+    def open_member(self, name: str) -> IO[bytes]:
+        """Opens a file of the archive as a binary stream."""
+
+    @abc.abstractmethod
+    def close(self):
+        """Closes the archive file."""
+
+
+class _ZipIndex(_ArchiveIndex):
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self._zip = zipfile.ZipFile(path)
+        for info in self._zip.infolist():
+            if info.is_dir():
+                self._add_dir(info.filename)
+                continue
+            mtime = time.mktime(info.date_time + (0, 0, -1))
+            self._add_file(info.filename, MemberStat(info.file_size, mtime))
+        self._names = {info.filename.strip("/"): info for info in self._zip.infolist()}
+
+    def open_member(self, name: str) -> IO[bytes]:
+        return self._zip.open(self._names[name])
+
+    def close(self):
+        self._zip.close()
+
+
+class _TarIndex(_ArchiveIndex):
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self._tar = tarfile.open(path, "r:*")
+        self._members: Dict[str, tarfile.TarInfo] = {}
+        for member in self._tar.getmembers():
+            if member.isdir():
+                self._add_dir(member.name)
+            elif member.isfile():
+                self._members[member.name.strip("/")] = member
+                self._add_file(member.name, MemberStat(member.size, member.mtime))
+
+    def open_member(self, name: str) -> IO[bytes]:
+        member_file = self._tar.extractfile(self._members[name])
+        assert member_file is not None
+        return member_file
+
+    def close(self):
+        self._tar.close()
+
+
+class ArchivePath:
+    """Path of a file or folder inside an archive."""
+
+    def __init__(self, index: _ArchiveIndex, inner: str = ""):
+        self._index = index
+        self._inner = posixpath.normpath(inner).strip("/") if inner else ""
+        if self._inner == ".":
+            self._inner = ""
+
+    @property
+    def name(self) -> str:
+        """Final component of the path"""
+        return posixpath.basename(self._inner)
+
+    def __truediv__(self, other: str) -> "ArchivePath":
+        return ArchivePath(self._index, posixpath.join(self._inner, str(other)))
+
+    def __str__(self) -> str:
+        return f"{self._index.path}/{self._inner}"
+
+    def __repr__(self) -> str:
+        return f"ArchivePath({str(self)!r})"
+
+    def __eq__(self, other) -> bool:
+        return (
+            isinstance(other, ArchivePath)
+            and self._index is other._index
+            and self._inner == other._inner
+        )
+
+    def __lt__(self, other: "ArchivePath") -> bool:
+        return self._inner < other._inner
+
+    def __hash__(self) -> int:
+        return hash((id(self._index), self._inner))
+
+    def exists(self) -> bool:
+        """Whether the path is a file or a folder of the archive"""
+        return self.is_file() or self.is_dir()
+
+    def is_dir(self) -> bool:
+        """Whether the path is a folder of the archive"""
+        return self._inner in self._index.dirs
+
+    def is_file(self) -> bool:
+        """Whether the path is a file of the archive"""
+        return self._inner in self._index.files
+
+    def iterdir(self) -> Iterator["ArchivePath"]:
+        """Iterates over the content of a folder"""
+        if not self.is_dir():
+            raise NotADirectoryError(str(self))
+        for child in self._index.dirs[self._inner]:
+            yield self / child
+
+    def glob(self, pattern: str) -> Iterator["ArchivePath"]:
+        """Iterates over the content of a folder matching a (flat) pattern"""
+        for child in self.iterdir():
+            if fnmatch.fnmatch(child.name, pattern):
+                yield child
+
+    def stat(self) -> MemberStat:
+        """Size and modification time of a file"""
+        if not self.is_file():
+            raise FileNotFoundError(str(self))
+        return self._index.files[self._inner]
+
+    def open(
+        self,
+        mode: str = "r",
+        encoding: Optional[str] = None,
+        newline: Optional[str] = None,
+    ) -> IO:
+        """Opens a file of the archive as a read-only stream"""
+        if mode not in ("r", "rb"):
+            raise ValueError(f"Archive members can not be opened with mode '{mode}'")
+        if not self.is_file():
+            raise FileNotFoundError(str(self))
+
+        member_file = self._index.open_member(self._inner)
+        if mode == "rb":
+            return member_file
+        return io.TextIOWrapper(member_file, encoding=encoding, newline=newline)
+
+    def close(self):
+        """Closes the archive (for every path inside it)"""
+        self._index.close()
+
+    def __enter__(self) -> "ArchivePath":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+RawPath = Union[Path, ArchivePath]
+
+
+def is_archive(path: Path) -> bool:
+    """Whether a file is an archive that can be read without extracting it"""
+    name = path.name.lower()
+    return name.endswith(".zip") or name.endswith(_TAR_SUFFIXES)
+
+
+def open_raw(path: Path) -> RawPath:
+    """
+    Opens the raw data of a dataset.
+
+    Returns the root of the archive if ``path`` is a zip or tar archive, or
+    ``path`` itself if it is a folder (e.g. an extracted archive).
+    """
+    if path.is_dir():
+        return path
+    name = path.name.lower()
+    if name.endswith(".zip"):
+        return ArchivePath(_ZipIndex(path))
+    if name.endswith(_TAR_SUFFIXES):
+        return ArchivePath(_TarIndex(path))
+    raise ValueError(f"Can not read '{path}' without extracting it")
+
+
+@contextlib.contextmanager
+def raw_data(path: Path) -> Iterator[RawPath]:
+    """Opens the raw data of a dataset (see ``open_raw``) and closes it on exit."""
+    raw_dir = open_raw(path)
+    try:
+        yield raw_dir
+    finally:
+        if isinstance(raw_dir, ArchivePath):
+            raw_dir.close()
+
+
+def iter_members(path: Path) -> Iterator[Tuple[str, IO[bytes]]]:
+    """
+    Iterates over the files of a tar or zip archive in archive order.
+
+    Each file is given as its name inside the archive and a binary stream,
+    which is only valid until the next iteration.
+    """
+    if path.name.lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as zip_file:
+            for info in zip_file.infolist():
+                if not info.is_dir():
+                    with zip_file.open(info) as member_file:
+                        yield info.filename, member_file
+        return
+
+    # Streaming mode: members are read as they are decompressed
+    with tarfile.open(path, "r|*") as tar:
+        for member in tar:
+            if member.isfile():
+                member_file = tar.extractfile(member)
+                assert member_file is not None
+                yield member.name, member_file
+
+
+def list_dir(path: RawPath) -> List[str]:
+    """Names of the content of a (raw data) folder, sorted"""
+    return sorted(child.name for child in path.iterdir())
@@ -0,0 +1,302 @@
+"""
+Sharded json output of a dataset.
+
+Instead of a single output file, the dataset is split into contiguous ranges
+of trajectories with about the same number of points. Each shard is a
+regular dataset json (``version``, ``trajs`` and ``labels``) compressed with
+the build codec, so it can be read on its own, and trajectories keep their
+dataset-wide ids. Shards are written inside a ``<name>-shards`` folder:
+
+- ``<name>-<i>-of-<n><ext>``: the shards (``ext`` depends on the codec)
+- ``index.json``: the codec and totals of the dataset, and for each shard its
+  file name, ``[start, end)`` trajectory range, number of points, size in
+  bytes (compressed and of the json) and the sha256 of its json.
+
+Shards whose json did not change since the previous build are not written
+again, so a partial update of a dataset only touches the affected shards.
+
+``GroupedJsonWriter`` writes any grouping of the trajectories this way (see
+also ``utils/label_partition.py``).
+"""
+
+import abc
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+from yupi import Trajectory
+from yupi.core import JSONSerializer
+
+from utils import instrument
+from utils.compression import Codec, open_binary_output, open_input
+
+SHARDS_DIR_SUFFIX = "-shards"
+SHARD_INDEX_FILE_NAME = "index.json"
+
+_JSON_SEPARATORS = (",", ":")
+_COPY_CHUNK_SIZE = 2**20
+
+# File name, trajectories (indices in the dataset) and extra index fields
+Group = Tuple[str, np.ndarray, Dict[str, Any]]
+
+
+def shards_dir(output_dir: Path, name: str) -> Path:
+    """Folder with the shards (and index) of a dataset."""
+    return output_dir / f"{name}{SHARDS_DIR_SUFFIX}"
+
+
+def shard_bounds(lengths: np.ndarray, n_shards: int) -> np.ndarray:
+    """
+    Splits trajectories into ``n_shards`` contiguous ranges with about the
+    same number of points. Every range has at least one trajectory, so there
+    are fewer ranges if there are fewer trajectories than shards.
+
+    Returns the ``n + 1`` boundaries of the ``n`` ranges.
+    """
+    n_trajs = len(lengths)
+    n_shards = max(1, min(n_shards, n_trajs))
+    cum_points = np.zeros(n_trajs + 1, dtype=np.int64)
+    np.cumsum(lengths, out=cum_points[1:])
+
+    bounds = np.zeros(n_shards + 1, dtype=np.int64)
+    bounds[-1] = n_trajs
+    for k in range(1, n_shards):
+        target = cum_points[-1] * k / n_shards
+        # Boundary with the closest cumulative number of points
+        bound = int(np.searchsorted(cum_points, target))
+        if bound > 0 and target - cum_points[bound - 1] < cum_points[bound] - target:
+            bound -= 1
+        bounds[k] = min(max(bound, bounds[k - 1] + 1), n_trajs - (n_shards - k))
+    return bounds
+
+
+class GroupedJsonWriter(abc.ABC):
+    """
+    Writes a dataset as several json files (inside a folder, along with an
+    index), each with a group of its trajectories, one trajectory at a time.
+
+    Trajectories are serialized as they are added and spilled to a temporary
+    file (inside the folder), since the groups are only known once every
+    trajectory was added. The files are written when the writer is closed.
+    Used as a context manager, nothing is written if an exception is raised.
+
+    Subclasses define the groups (``_groups``), the key of the groups in the
+    index (``GROUPS_KEY``) and the pattern of their file names
+    (``_files_glob``).
+    """
+
+    GROUPS_KEY = "groups"
+
+    def __init__(self, path: Path, name: str, version: int, codec: Codec):
+        self.name = name
+        self.version = version
+        self.codec = codec
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._tmp_dir = Path(tempfile.mkdtemp(prefix=".spill-", dir=self.path))
+        self._spill_path = self._tmp_dir / "trajs.json"
+        self._spill_file = open(self._spill_path, "wb")
+        # Every trajectory is followed by a comma in the spilled json
+        self._ends: List[int] = []
+        self._lengths: List[int] = []
+        self._labels: List[Any] = []
+        self._encode = json.JSONEncoder(
+            ensure_ascii=False, separators=_JSON_SEPARATORS
+        ).encode
+        self._closed = False
+
+    def add(self, traj: Trajectory, label: Any):
+        """Serializes and adds a trajectory (and its label)."""
+        with instrument.stage("to_json", memory=False):
+            traj_json = JSONSerializer.to_json(traj)
+        self._spill_file.write(self._encode(traj_json).encode("utf-8"))
+        self._spill_file.write(b",")
+        self._ends.append(self._spill_file.tell())
+        self._lengths.append(len(traj))
+        self._labels.append(label)
+
+    @abc.abstractmethod
+    def _groups(self) -> List[Group]:
+        """Files to write and the trajectories in each of them."""
+
+    @abc.abstractmethod
+    def _files_glob(self) -> str:
+        """Pattern matching the names of the files of the groups."""
+
+    def close(self) -> Path:
+        """Writes the files of the groups and their index. Returns its path."""
+        index_path = self.path / SHARD_INDEX_FILE_NAME
+        if self._closed:
+            return index_path
+        try:
+            self._spill_file.close()
+            groups = self._groups()
+            prev_groups = self._previous_groups(index_path)
+            workers = max(1, min(len(groups), os.cpu_count() or 1))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                entries = list(
+                    executor.map(
+                        lambda group: self._write_group(*group, prev_groups), groups
+                    )
+                )
+
+            index = {
+                "name": self.name,
+                "version": self.version,
+                "codec": str(self.codec),
+                "trajs": len(self._lengths),
+                "points": int(np.sum(self._lengths, dtype=np.int64)),
+                self.GROUPS_KEY: entries,
+            }
+            tmp_index_path = index_path.with_suffix(".tmp")
+            with open(tmp_index_path, "w", encoding="utf-8") as index_file:
+                json.dump(index, index_file, indent=4)
+            tmp_index_path.replace(index_path)
+
+            files = {entry["file"] for entry in entries}
+            for path in self.path.glob(self._files_glob()):
+                if path.name not in files:
+                    path.unlink()
+        finally:
+            self.discard()
+        return index_path
+
+    def discard(self):
+        """Removes the spilled data without writing any file."""
+        self._closed = True
+        self._spill_file.close()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+
+    def _previous_groups(self, index_path: Path) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(index_path, "r", encoding="utf-8") as index_file:
+                index = json.load(index_file)
+        except (OSError, json.JSONDecodeError):
+            return {}
+        if index.get("codec") != str(self.codec):
+            return {}
+        return {entry["file"]: entry for entry in index.get(self.GROUPS_KEY, [])}
+
+    def _spilled_runs(self, indices: np.ndarray) -> List[Tuple[int, int]]:
+        """
+        Byte ranges of the spilled json of some (sorted) trajectories, merging
+        consecutive ones, without the comma after the last trajectory.
+        """
+        if len(indices) == 0:
+            return []
+        ends = np.asarray(self._ends, dtype=np.int64)
+        breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+        run_first = indices[np.r_[0, breaks]]
+        run_last = indices[np.r_[breaks - 1, len(indices) - 1]]
+        starts = np.where(run_first > 0, ends[np.maximum(run_first - 1, 0)], 0)
+        runs = list(zip(starts.tolist(), ends[run_last].tolist()))
+        runs[-1] = (runs[-1][0], runs[-1][1] - 1)
+        return runs
+
+    def _read_spilled(
+        self, runs: List[Tuple[int, int]], consume: Callable[[bytes], Any]
+    ):
+        """Passes the spilled json of some byte ranges, in chunks."""
+        with open(self._spill_path, "rb") as spill_file:
+            for first, last in runs:
+                spill_file.seek(first)
+                remaining = last - first
+                while remaining > 0:
+                    chunk = spill_file.read(min(_COPY_CHUNK_SIZE, remaining))
+                    remaining -= len(chunk)
+                    consume(chunk)
+
+    def _write_group(
+        self,
+        file_name: str,
+        indices: np.ndarray,
+        extra: Dict[str, Any],
+        prev_groups: Dict[str, Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        path = self.path / file_name
+        labels = [self._labels[i] for i in indices]
+        head = f'{{"version":{self._encode(self.version)},"trajs":['.encode("utf-8")
+        tail = f'],"labels":{self._encode(labels)}}}'.encode("utf-8")
+        runs = self._spilled_runs(indices)
+
+        sha = hashlib.sha256(head)
+        self._read_spilled(runs, sha.update)
+        sha.update(tail)
+        digest = sha.hexdigest()
+
+        prev = prev_groups.get(file_name)
+        if prev is None or prev.get("sha256") != digest or not path.exists():
+            member_name = f"{file_name[: -len(self.codec.extension)]}.json"
+            with open_binary_output(path, member_name, self.codec) as group_file:
+                group_file.write(head)
+                self._read_spilled(runs, group_file.write)
+                group_file.write(tail)
+
+        json_bytes = sum(last - first for first, last in runs)
+        return {
+            "file": file_name,
+            **extra,
+            "points": int(np.sum(np.asarray(self._lengths)[indices], dtype=np.int64)),
+            "bytes": path.stat().st_size,
+            "json_bytes": len(head) + json_bytes + len(tail),
+            "sha256": digest,
+        }
+
+    def __enter__(self) -> "GroupedJsonWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class ShardWriter(GroupedJsonWriter):
+    """Writes a dataset as shards of about the same number of points."""
+
+    GROUPS_KEY = "shards"
+
+    def __init__(
+        self, output_dir: Path, name: str, version: int, n_shards: int, codec: Codec
+    ):
+        if n_shards < 1:
+            raise ValueError(f"The number of shards must be positive, got {n_shards}")
+        super().__init__(shards_dir(output_dir, name), name, version, codec)
+        self.n_shards = n_shards
+
+    def _groups(self) -> List[Group]:
+        bounds = shard_bounds(np.asarray(self._lengths), self.n_shards)
+        n_shards = len(bounds) - 1
+        ext = self.codec.extension
+        return [
+            (
+                f"{self.name}-{shard:05d}-of-{n_shards:05d}{ext}",
+                np.arange(bounds[shard], bounds[shard + 1]),
+                {"trajs": [int(bounds[shard]), int(bounds[shard + 1])]},
+            )
+            for shard in range(n_shards)
+        ]
+
+    def _files_glob(self) -> str:
+        return f"{self.name}-*-of-*"
+
+
+def load_shard_index(path: Path) -> Dict[str, Any]:
+    """Loads the index of a sharded dataset (``path`` is its shards folder)."""
+    with open(path / SHARD_INDEX_FILE_NAME, "r", encoding="utf-8") as index_file:
+        return json.load(index_file)
+
+
+def read_shard(path: Path) -> Tuple[List[Trajectory], List[Any]]:
+    """Reads the trajectories and labels of a shard file."""
+    with open_input(path) as shard_file:
+        data = json.load(shard_file)
+    trajs = [JSONSerializer.from_json(traj) for traj in data["trajs"]]
+    return trajs, data["labels"]
@@ -0,0 +1,257 @@
+"""
+Spatial index over the extents of the trajectories of a dataset.
+
+Each trajectory is split into chunks of consecutive points (every chunk
+includes the first point of the next one, so all its segments are covered)
+and the bounding boxes of the chunks are packed into an R-tree:
+
+- Leaves are the chunk boxes, sorted with Sort-Tile-Recursive (STR): sliced
+  by the center of their first coordinate and sorted by the second one
+  inside each slice.
+- Each upper level groups ``NODE_CAPACITY`` consecutive nodes of the level
+  below, so the children of node ``k`` are nodes ``k * NODE_CAPACITY`` to
+  ``(k + 1) * NODE_CAPACITY - 1`` and only the boxes need to be stored.
+
+The index is saved as ``<name>.rtree.npz`` with the arrays:
+
+- ``entry_min``, ``entry_max``: box of each chunk (shape ``(n_chunks, dim)``)
+- ``entry_traj``, ``entry_start``, ``entry_end``: int64 trajectory id and
+  point range of each chunk
+- ``level_<i>_min``, ``level_<i>_max``: node boxes of each level, ``0``
+  being the one right above the leaves
+- ``n_levels``, ``node_capacity``
+
+Queries return the ids of the candidate trajectories: those with a chunk
+box intersecting the query region. An exact query also checks the points of
+the candidate chunks.
+"""
+
+import math
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import numpy as np
+from yupi import Trajectory
+
+SPATIAL_INDEX_EXTENSION = ".rtree.npz"
+
+CHUNK_POINTS = 32
+NODE_CAPACITY = 16
+
+# Points of a chunk given its trajectory id and point range
+PointsGetter = Callable[[int, int, int], np.ndarray]
+
+
+def chunk_boxes(r: np.ndarray, chunk_points: int = CHUNK_POINTS):
+    """
+    Splits a trajectory (of at least 2 points) into chunks. Returns the
+    start and end of each chunk and their bounding boxes.
+    """
+    n_points = len(r)
+    starts = np.arange(0, n_points - 1, chunk_points)
+    ends = np.minimum(starts + chunk_points + 1, n_points)
+    box_min = np.minimum.reduceat(r, starts, axis=0)
+    box_max = np.maximum.reduceat(r, starts, axis=0)
+    # reduceat stops before the next start, add the shared point
+    box_min = np.minimum(box_min, r[ends - 1])
+    box_max = np.maximum(box_max, r[ends - 1])
+    return starts, ends, box_min, box_max
+
+
+def _str_order(box_min: np.ndarray, box_max: np.ndarray, capacity: int) -> np.ndarray:
+    """Sort-Tile-Recursive order of boxes (by the first two coordinates)."""
+    n_boxes, dim = box_min.shape
+    if n_boxes == 0:
+        return np.arange(0)
+    centers = (box_min + box_max) / 2
+    if dim < 2 or n_boxes <= capacity:
+        return np.argsort(centers[:, 0], kind="stable")
+
+    n_nodes = math.ceil(n_boxes / capacity)
+    slice_size = math.ceil(math.sqrt(n_nodes)) * capacity
+    by_x = np.argsort(centers[:, 0], kind="stable")
+    slices = [
+        by_x[start : start + slice_size] for start in range(0, n_boxes, slice_size)
+    ]
+    return np.concatenate(
+        [slc[np.argsort(centers[slc, 1], kind="stable")] for slc in slices]
+    )
+
+
+def _group_boxes(box_min: np.ndarray, box_max: np.ndarray, capacity: int):
+    starts = np.arange(0, len(box_min), capacity)
+    return (
+        np.minimum.reduceat(box_min, starts, axis=0),
+        np.maximum.reduceat(box_max, starts, axis=0),
+    )
+
+
+class SpatialIndexWriter:
+    """Collects the chunk boxes of each trajectory and writes the index."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._starts: List[np.ndarray] = []
+        self._ends: List[np.ndarray] = []
+        self._box_min: List[np.ndarray] = []
+        self._box_max: List[np.ndarray] = []
+        self._n_trajs = 0
+
+    def add(self, traj: Trajectory, label=None):
+        """Adds the chunks of the next trajectory (ids are consecutive)."""
+        # pylint: disable=unused-argument
+        starts, ends, box_min, box_max = chunk_boxes(
+            np.asarray(traj.r, dtype=np.float64)
+        )
+        self._starts.append(starts)
+        self._ends.append(ends)
+        self._box_min.append(box_min)
+        self._box_max.append(box_max)
+        self._n_trajs += 1
+
+    def close(self) -> Path:
+        """Packs the R-tree and writes it (atomically)."""
+        n_chunks = [len(starts) for starts in self._starts]
+        dim = self._box_min[0].shape[1] if self._box_min else 0
+        entry_traj = np.repeat(np.arange(self._n_trajs, dtype=np.int64), n_chunks)
+        entry_start = np.concatenate([np.zeros(0, np.int64), *self._starts])
+        entry_end = np.concatenate([np.zeros(0, np.int64), *self._ends])
+        entry_min = np.concatenate([np.zeros((0, dim)), *self._box_min])
+        entry_max = np.concatenate([np.zeros((0, dim)), *self._box_max])
+
+        order = _str_order(entry_min, entry_max, NODE_CAPACITY)
+        arrays = {
+            "entry_min": entry_min[order],
+            "entry_max": entry_max[order],
+            "entry_traj": entry_traj[order],
+            "entry_start": entry_start[order].astype(np.int64),
+            "entry_end": entry_end[order].astype(np.int64),
+        }
+
+        level_min, level_max = arrays["entry_min"], arrays["entry_max"]
+        n_levels = 0
+        while len(level_min) > 1:
+            level_min, level_max = _group_boxes(level_min, level_max, NODE_CAPACITY)
+            arrays[f"level_{n_levels}_min"] = level_min
+            arrays[f"level_{n_levels}_max"] = level_max
+            n_levels += 1
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with open(tmp_path, "wb") as index_file:
+            np.savez(
+                index_file,
+                n_levels=np.int64(n_levels),
+                node_capacity=np.int64(NODE_CAPACITY),
+                **arrays,
+            )
+        tmp_path.replace(self.path)
+        return self.path
+
+
+def _box_distance(
+    box_min: np.ndarray, box_max: np.ndarray, center: np.ndarray
+) -> np.ndarray:
+    gap = np.maximum(np.maximum(box_min - center, center - box_max), 0)
+    return np.sqrt(np.sum(gap**2, axis=1))
+
+
+class SpatialIndex:
+    """R-tree over the chunk boxes of the trajectories of a dataset."""
+
+    def __init__(self, arrays: dict):
+        self.entry_min = arrays["entry_min"]
+        self.entry_max = arrays["entry_max"]
+        self.entry_traj = arrays["entry_traj"]
+        self.entry_start = arrays["entry_start"]
+        self.entry_end = arrays["entry_end"]
+        self.node_capacity = int(arrays["node_capacity"])
+        n_levels = int(arrays["n_levels"])
+        self.levels = [
+            (arrays[f"level_{i}_min"], arrays[f"level_{i}_max"])
+            for i in range(n_levels)
+        ]
+
+    def _entries(self, low: np.ndarray, high: np.ndarray) -> np.ndarray:
+        """Chunks whose box intersects ``[low, high]``."""
+        candidates: Optional[np.ndarray] = None
+        boxes = [*reversed(self.levels), (self.entry_min, self.entry_max)]
+        for box_min, box_max in boxes:
+            if candidates is None:
+                candidates = np.arange(len(box_min))
+            else:
+                children = np.arange(self.node_capacity)
+                candidates = (
+                    candidates[:, None] * self.node_capacity + children
+                ).ravel()
+                candidates = candidates[candidates < len(box_min)]
+            hit = np.all(
+                (box_min[candidates] <= high) & (box_max[candidates] >= low), axis=1
+            )
+            candidates = candidates[hit]
+        return candidates
+
+    def _refine(self, entries: np.ndarray, points: PointsGetter, match) -> np.ndarray:
+        matched = [
+            entry
+            for entry in entries
+            if np.any(
+                match(
+                    points(
+                        int(self.entry_traj[entry]),
+                        int(self.entry_start[entry]),
+                        int(self.entry_end[entry]),
+                    )
+                )
+            )
+        ]
+        return np.asarray(matched, dtype=np.int64)
+
+    def query_bbox(
+        self, low, high, points: Optional[PointsGetter] = None
+    ) -> np.ndarray:
+        """
+        Ids of the trajectories passing through the box ``[low, high]``.
+
+        Without ``points`` the ids are candidates: some chunk box of the
+        trajectory intersects the query box. With ``points`` (returning the
+        points of a trajectory in a range) only trajectories with a point
+        inside the query box are kept.
+        """
+        low, high = np.asarray(low, dtype=float), np.asarray(high, dtype=float)
+        entries = self._entries(low, high)
+        if points is not None:
+            entries = self._refine(
+                entries,
+                points,
+                lambda r: np.all((r >= low) & (r <= high), axis=1),
+            )
+        return np.unique(self.entry_traj[entries])
+
+    def query_radius(
+        self, center, radius: float, points: Optional[PointsGetter] = None
+    ) -> np.ndarray:
+        """
+        Ids of the trajectories passing within ``radius`` (euclidean, in the
+        units of the coordinates) of ``center``. See ``query_bbox``.
+        """
+        center = np.asarray(center, dtype=float)
+        entries = self._entries(center - radius, center + radius)
+        near = (
+            _box_distance(self.entry_min[entries], self.entry_max[entries], center)
+            <= radius
+        )
+        entries = entries[near]
+        if points is not None:
+            entries = self._refine(
+                entries,
+                points,
+                lambda r: np.sum((r - center) ** 2, axis=1) <= radius**2,
+            )
+        return np.unique(self.entry_traj[entries])
+
+
+def read_spatial_index(path: Path) -> SpatialIndex:
+    """Loads a spatial index file."""
+    with np.load(path, allow_pickle=False) as index_data:
+        return SpatialIndex(dict(index_data.items()))
@@ -0,0 +1,149 @@
+"""
+Per-trajectory summary of a dataset.
+
+Every build writes a ``<name>.summary.npz`` file next to the dataset with one
+row per trajectory, stored as typed columns, so datasets can be filtered
+without deserializing any trajectory:
+
+- ``ids``: int64 id of the trajectory (its index in the dataset)
+- ``labels``: label of the trajectory. If the labels are not all of the same
+  type (see ``utils/columnar.py``), their json strings are stored instead and
+  ``labels_json`` is set.
+- ``n_points``: int64 number of points
+- ``t_start``, ``t_end``, ``duration``: first and last time, and their
+  difference
+- ``r_min``, ``r_max``: bounding box (shape ``(n_trajs, dim)``)
+- ``dt_mean``, ``dt_std``, ``dt_min``, ``dt_max``: statistics of the time
+  steps
+- ``version``: version of the dataset
+- ``labels_json``: whether ``labels`` holds the json of each label
+
+Columns are float64 unless stated otherwise.
+"""
+
+import json
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+from yupi import Trajectory
+
+from utils.columnar import labels_array
+
+SUMMARY_EXTENSION = ".summary.npz"
+
+_FLOAT_COLUMNS = (
+    "t_start",
+    "t_end",
+    "duration",
+    "dt_mean",
+    "dt_std",
+    "dt_min",
+    "dt_max",
+)
+
+
+class Summary(NamedTuple):
+    """Per-trajectory summary columns of a dataset."""
+
+    ids: np.ndarray
+    labels: np.ndarray
+    n_points: np.ndarray
+    t_start: np.ndarray
+    t_end: np.ndarray
+    duration: np.ndarray
+    r_min: np.ndarray
+    r_max: np.ndarray
+    dt_mean: np.ndarray
+    dt_std: np.ndarray
+    dt_min: np.ndarray
+    dt_max: np.ndarray
+    version: int
+    labels_json: bool = False
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def in_bbox(self, low, high) -> np.ndarray:
+        """Mask of the trajectories fully inside the box ``[low, high]``."""
+        low, high = np.asarray(low, dtype=float), np.asarray(high, dtype=float)
+        return np.all((self.r_min >= low) & (self.r_max <= high), axis=1)
+
+
+class SummaryWriter:
+    """Collects the summary of each trajectory and writes the summary file."""
+
+    def __init__(self, path: Path, version: int):
+        self.path = path
+        self.version = version
+        self._labels: List[Any] = []
+        self._columns: Dict[str, List[float]] = {col: [] for col in _FLOAT_COLUMNS}
+        self._n_points: List[int] = []
+        self._r_min: List[np.ndarray] = []
+        self._r_max: List[np.ndarray] = []
+        self._dim: Optional[int] = None
+
+    def add(self, traj: Trajectory, label: Any):
+        """Adds the summary of a trajectory (of at least 2 points)."""
+        r = np.asarray(traj.r, dtype=np.float64)
+        t = np.asarray(traj.t, dtype=np.float64)
+        if self._dim is None:
+            self._dim = r.shape[1]
+        dt = np.diff(t)
+        values = {
+            "t_start": t[0],
+            "t_end": t[-1],
+            "duration": t[-1] - t[0],
+            "dt_mean": dt.mean(),
+            "dt_std": dt.std(),
+            "dt_min": dt.min(),
+            "dt_max": dt.max(),
+        }
+        for col, value in values.items():
+            self._columns[col].append(float(value))
+        self._n_points.append(len(r))
+        self._r_min.append(r.min(axis=0))
+        self._r_max.append(r.max(axis=0))
+        self._labels.append(label)
+
+    def close(self) -> Path:
+        """Writes the summary file (atomically)."""
+        dim = 0 if self._dim is None else self._dim
+        n_trajs = len(self._n_points)
+        labels_json = False
+        try:
+            labels = labels_array(self._labels)
+        except ValueError:
+            # The summary is always written, so any json label must be stored
+            labels_json = True
+            labels = np.asarray(
+                [json.dumps(label) for label in self._labels], dtype=str
+            )
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with open(tmp_path, "wb") as summary_file:
+            np.savez(
+                summary_file,
+                ids=np.arange(n_trajs, dtype=np.int64),
+                labels=labels,
+                labels_json=np.bool_(labels_json),
+                n_points=np.asarray(self._n_points, dtype=np.int64),
+                r_min=np.asarray(self._r_min, dtype=np.float64).reshape(n_trajs, dim),
+                r_max=np.asarray(self._r_max, dtype=np.float64).reshape(n_trajs, dim),
+                version=np.int64(self.version),
+                **{
+                    col: np.asarray(values, dtype=np.float64)
+                    for col, values in self._columns.items()
+                },
+            )
+        tmp_path.replace(self.path)
+        return self.path
+
+
+def read_summary(path: Path) -> Summary:
+    """Loads a summary file."""
+    with np.load(path, allow_pickle=False) as summary_data:
+        data = dict(summary_data.items())
+    data["version"] = int(data["version"])
+    data["labels_json"] = bool(data.get("labels_json", False))
+    return Summary(**data)
@@ -0,0 +1,216 @@
+"""
+Fast parsing of timestamp columns.
+
+Raw datasets store timestamps as strings with a fixed ``strptime`` format.
+``parse_datetimes`` parses a whole column of them into a ``datetime64`` array
+at once. Formats made only of numeric fields (``%Y``, ``%m``, ``%d``, ``%H``,
+``%M``, ``%S`` and ``%f``) and literal separators are parsed with NumPy.
+Any other format, or columns whose values do not follow that layout (e.g.
+padding with spaces), are parsed with a memoized ``strptime`` over their
+distinct values instead.
+
+Surrounding whitespace of the values is always ignored.
+"""
+
+import functools
+import re
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+# Fields supported by the vectorized parser, with their (maximum) width
+_FIELD_WIDTHS = {"Y": 4, "m": 2, "d": 2, "H": 2, "M": 2, "S": 2, "f": 6}
+_FIELD_RANGES = {
+    "Y": (1, 9999),
+    "m": (1, 12),
+    "d": (1, 31),
+    "H": (0, 23),
+    "M": (0, 59),
+    "S": (0, 59),
+}
+# Values of the fields missing in a format (same as strptime)
+_FIELD_DEFAULTS = {"Y": 1900, "m": 1, "d": 1, "H": 0, "M": 0, "S": 0, "f": 0}
+
+_PARSE_CACHE_SIZE = 2**16
+
+# Fields ("%Y" -> "Y") and literals of a format, in order
+Tokens = Tuple[Tuple[bool, str], ...]
+# Field and its start and end position inside a value
+Span = Tuple[str, int, int]
+
+Values = Union[np.ndarray, Iterable[str]]
+
+
+@functools.lru_cache(maxsize=_PARSE_CACHE_SIZE)
+def parse_datetime(value: str, fmt: str) -> datetime:
+    """Parses a single timestamp with ``strptime`` (memoized)."""
+    return datetime.strptime(value.strip(), fmt)
+
+
+def parse_datetimes(values: Values, fmt: str) -> np.ndarray:
+    """
+    Parses a column of timestamps.
+
+    Parameters
+    ----------
+    values : Values
+        Timestamps as strings.
+    fmt : str
+        ``strptime`` format of the timestamps.
+
+    Returns
+    -------
+    np.ndarray
+        Timestamps as ``datetime64[us]`` if the format has fractions of
+        seconds (``%f``), or as ``datetime64[s]`` otherwise.
+    """
+    unit = "us" if "%f" in fmt else "s"
+    values = np.asarray(values, dtype=str)
+    if values.size == 0:
+        return np.empty(values.shape, dtype=f"datetime64[{unit}]")
+
+    tokens = _fast_tokens(fmt)
+    if tokens is not None:
+        parsed = _parse_fast(values.ravel(), tokens, unit)
+        if parsed is not None:
+            return parsed.reshape(values.shape)
+
+    uniques, inverse = np.unique(values, return_inverse=True)
+    parsed = np.array(
+        [parse_datetime(value, fmt) for value in uniques],
+        dtype=f"datetime64[{unit}]",
+    )
+    return parsed[inverse].reshape(values.shape)
+
+
+def elapsed_seconds(times: np.ndarray) -> np.ndarray:
+    """Seconds (as float) from the first timestamp to each timestamp."""
+    if len(times) == 0:
+        return np.empty(0, dtype=np.float64)
+    return (times - times[0]) / np.timedelta64(1, "s")
+
+
+def parse_elapsed_seconds(values: Values, fmt: str) -> np.ndarray:
+    """Parses a column of timestamps as seconds since the first one."""
+    return elapsed_seconds(parse_datetimes(values, fmt))
+
+
+@functools.lru_cache(maxsize=None)
+def _fast_tokens(fmt: str) -> Optional[Tokens]:
+    """
+    Splits a format into fields and literals. Returns None if the format is
+    not supported by the vectorized parser.
+    """
+    tokens = []
+    seen = set()
+    for field, literal in re.findall(r"%(.)|([^%]+)", fmt):
+        if literal:
+            if any(char.isdigit() for char in literal):
+                return None
+            tokens.append((False, literal))
+        elif field in _FIELD_WIDTHS and field not in seen:
+            tokens.append((True, field))
+            seen.add(field)
+        else:
+            return None
+    if "".join(f"%{val}" if is_field else val for is_field, val in tokens) != fmt:
+        return None
+    return tuple(tokens)
+
+
+@functools.lru_cache(maxsize=_PARSE_CACHE_SIZE)
+def _field_spans(template: str, tokens: Tokens) -> Optional[Tuple[Span, ...]]:
+    """
+    Finds the position of each field in the values matching a template
+    (values with every digit replaced by ``0``).
+
+    Fields followed by a literal can have any width (as in strptime), while
+    adjacent fields need a fixed width to be told apart. Returns None if the
+    template does not match the format.
+    """
+    pos = len(template) - len(template.lstrip())
+    end = len(template.rstrip())
+    spans = []
+    for i, (is_field, value) in enumerate(tokens):
+        if not is_field:
+            if not template.startswith(value, pos):
+                return None
+            pos += len(value)
+            continue
+
+        run_end = pos
+        while run_end < end and template[run_end] == "0":
+            run_end += 1
+        if i + 1 < len(tokens) and tokens[i + 1][0]:
+            width = _FIELD_WIDTHS[value]
+        else:
+            width = run_end - pos
+        min_width = _FIELD_WIDTHS[value] if value == "Y" else 1
+        if not min_width <= width <= _FIELD_WIDTHS[value] or pos + width > run_end:
+            return None
+        spans.append((value, pos, pos + width))
+        pos += width
+    return tuple(spans) if pos == end else None
+
+
+def _parse_fast(values: np.ndarray, tokens: Tokens, unit: str) -> Optional[np.ndarray]:
+    try:
+        chars = values.astype(bytes)
+    except UnicodeEncodeError:
+        return None
+    width = chars.dtype.itemsize
+    matrix = chars.view(np.uint8).reshape(-1, width)
+    digits = matrix.astype(np.int64) - ord("0")
+    is_digit = (digits >= 0) & (digits <= 9)
+
+    # Values are grouped by template: all the values of a group have their
+    # fields at the same positions
+    templates = np.where(is_digit, ord("0"), matrix).astype(np.uint8)
+    templates = np.ascontiguousarray(templates).view(f"V{width}").ravel()
+    uniques, inverse = np.unique(templates, return_inverse=True)
+
+    fields: Dict[str, np.ndarray] = {
+        value: np.empty(len(values), dtype=np.int64)
+        for is_field, value in tokens
+        if is_field
+    }
+    for group, template in enumerate(uniques):
+        template_str = template.tobytes().rstrip(b"\0").decode("ascii")
+        spans = _field_spans(template_str, tokens)
+        if spans is None:
+            return None
+        rows = np.flatnonzero(inverse == group) if len(uniques) > 1 else slice(None)
+        for field, start, end in spans:
+            powers = 10 ** np.arange(end - start - 1, -1, -1)
+            field_values = digits[rows, start:end] @ powers
+            if field == "f":
+                field_values *= 10 ** (_FIELD_WIDTHS["f"] - (end - start))
+            fields[field][rows] = field_values
+    return _to_datetime64(fields, len(values), unit)
+
+
+def _to_datetime64(
+    fields: Dict[str, np.ndarray], size: int, unit: str
+) -> Optional[np.ndarray]:
+    for field, (low, high) in _FIELD_RANGES.items():
+        if field in fields and np.any((fields[field] < low) | (fields[field] > high)):
+            return None
+
+    def get(field: str) -> np.ndarray:
+        if field in fields:
+            return fields[field]
+        return np.full(size, _FIELD_DEFAULTS[field], dtype=np.int64)
+
+    years = (get("Y") - 1970).astype("datetime64[Y]")
+    months = years.astype("datetime64[M]") + (get("m") - 1)
+    days = months.astype("datetime64[D]") + (get("d") - 1)
+    if np.any(days.astype("datetime64[M]") != months):
+        # Days beyond the end of the month
+        return None
+
+    seconds = get("H") * 3600 + get("M") * 60 + get("S")
+    times = days.astype(f"datetime64[{unit}]") + seconds.astype("timedelta64[s]")
+    if unit == "us":
+        times += get("f").astype("timedelta64[us]")
+    return times
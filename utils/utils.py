@@ -1,11 +1,27 @@
 import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Dict, List, Mapping, Optional
 
 import patoolib
 import requests
 from requests import Response
+from requests.adapters import HTTPAdapter
 
 import config as cfg
+from utils import instrument
+from utils.manifest import file_sha256, load_manifest, save_manifest
+from utils.rawfs import is_archive
+
+DOWNLOAD_POLICY_OVERWRITE = "overwrite"
+DOWNLOAD_POLICY_KEEP = "keep"
+DOWNLOAD_POLICY_FAIL = "fail"
+
+_SESSION: Optional[requests.Session] = None
+_SESSION_LOCK = threading.Lock()
+_DOWNLOAD_MANIFEST_LOCK = threading.Lock()
 
 
 def _get_path(path: str, *args) -> Path:
@@ -32,92 +48,431 @@ def _create_dataset_path(dataset_name: str) -> Path:
     return dataset_path
 
 
-def _start_download(url: str, dataset_name: str) -> Response:
+def _get_session() -> requests.Session:
+    """Returns the http session shared by all the downloads."""
+    global _SESSION  # pylint: disable=global-statement
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            adapter = HTTPAdapter(
+                pool_connections=cfg.DOWNLOAD_MAX_WORKERS,
+                pool_maxsize=cfg.DOWNLOAD_MAX_WORKERS,
+            )
+            _SESSION = requests.Session()
+            _SESSION.mount("http://", adapter)
+            _SESSION.mount("https://", adapter)
+        return _SESSION
+
+
+_CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-\d+/(?:\d+|\*)")
+
+
+class DownloadError(RuntimeError):
+    """A download request failed with an unexpected status code."""
+
+    def __init__(self, msg: str, status_code: int):
+        super().__init__(msg)
+        self.status_code = status_code
+
+
+def _part_path(dataset_file_path: Path) -> Path:
+    return dataset_file_path.with_name(dataset_file_path.name + ".part")
+
+
+def _start_download(
+    url: str,
+    dataset_name: str,
+    resume_from: int = 0,
+    headers: Optional[Dict[str, str]] = None,
+) -> Response:
     logging.info("Downloading %s dataset", dataset_name)
-    response = requests.get(url, allow_redirects=True, stream=True)
-    if response.status_code != 200:
-        raise RuntimeError(f"Failed to download dataset {dataset_name}")
+    # Ask for the raw bytes, so sizes and ranges refer to the stored file
+    headers = {"Accept-Encoding": "identity", **(headers or {})}
+    if resume_from:
+        headers["Range"] = f"bytes={resume_from}-"
+    response = _get_session().get(
+        url,
+        allow_redirects=True,
+        stream=True,
+        headers=headers,
+        timeout=cfg.DOWNLOAD_TIMEOUT,
+    )
+    # Not modified only makes sense as the answer to a conditional request
+    conditional = "If-None-Match" in headers or "If-Modified-Since" in headers
+    expected = (200, 206, 304) if conditional else (200, 206)
+    if response.status_code not in expected:
+        response.close()
+        raise DownloadError(
+            f"Failed to download dataset {dataset_name} "
+            f"(status {response.status_code})",
+            response.status_code,
+        )
     return response
 
 
-def _download_until_finish(url: str, response: Response, dataset_path: Path) -> Path:
+def _remote_headers(url: str) -> Mapping[str, str]:
+    """Gets the headers of a remote file without downloading it."""
+    response = _get_session().head(
+        url,
+        allow_redirects=True,
+        headers={"Accept-Encoding": "identity"},
+        timeout=cfg.DOWNLOAD_TIMEOUT,
+    )
+    return response.headers if response.status_code == 200 else {}
+
+
+def _if_range(validators: Optional[dict]) -> Optional[str]:
+    """Validator of a partial download to send as If-Range, if any."""
+    if validators is None:
+        return None
+    etag = validators.get("etag")
+    # Weak etags can not be used to combine ranges
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validators.get("last_modified")
+
+
+def _resumed_from(response: Response) -> Optional[int]:
+    """First byte of a partial response, None if it is not one."""
+    if response.status_code != 206:
+        return None
+    match = _CONTENT_RANGE_RE.fullmatch(response.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else None
+
+
+def _resume_download(url: str, dataset_name: str, dataset_file_path: Path) -> Response:
+    """
+    Starts a download, continuing from a previous partial download if there
+    is one, the remote file did not change since it started (If-Range) and
+    the server supports it. Otherwise the download starts from zero.
+    """
+    part_path = _part_path(dataset_file_path)
+    resume_from = part_path.stat().st_size if part_path.exists() else 0
+    if not resume_from:
+        return _start_download(url, dataset_name)
+
+    if_range = _if_range(_get_download_entry(dataset_name, part_path.name))
+    if if_range is None:
+        logging.warning("Partial download can not be validated, starting from zero")
+        part_path.unlink()
+        return _start_download(url, dataset_name)
+
+    logging.info(
+        "Resuming %s download from %.2f MB", dataset_name, resume_from / 1024**2
+    )
+    try:
+        response = _start_download(
+            url, dataset_name, resume_from, headers={"If-Range": if_range}
+        )
+    except DownloadError as err:
+        if err.status_code != 416:
+            raise
+        # The partial download is not valid anymore
+        logging.warning("Could not resume download, starting from zero")
+        part_path.unlink()
+        return _start_download(url, dataset_name)
+
+    if response.status_code == 200:
+        # The remote file changed (or ranges are not supported): the
+        # response is the whole file, which replaces the partial download
+        logging.warning("Remote file changed, starting the download from zero")
+        return response
+    if _resumed_from(response) != resume_from:
+        logging.warning("Unexpected range in the response, starting from zero")
+        response.close()
+        part_path.unlink()
+        return _start_download(url, dataset_name)
+    return response
+
+
+def _download_until_finish(
+    url: str,
+    dataset_name: str,
+    response: Response,
+    dataset_path: Path,
+    show_progress: bool = True,
+) -> Path:
+    dataset_file_path = dataset_path / url.split("/")[-1]
+    part_path = _part_path(dataset_file_path)
+
+    # Append to the partial download only if the server sent the missing part
+    resumed = response.status_code == 206 and part_path.exists()
+    downloaded = part_path.stat().st_size if resumed else 0
+    if not resumed:
+        # Validators of the partial download, to resume it only if the remote
+        # file does not change
+        _record_partial(dataset_name, part_path.name, response.headers)
+
     data_length = int(response.headers.get("content-length", -1))
+    if data_length != -1:
+        data_length += downloaded
     size_mb_msg = (
         f"    Size: {data_length / 1024 ** 2:.2f} MB" if data_length != -1 else ""
     )
-    dataset_file_path = dataset_path / url.split("/")[-1]
-    with open(dataset_file_path, "wb") as ds_file:
-        downloaded = 0
+    with response, open(part_path, "ab" if resumed else "wb") as ds_file:
         for chunk in response.iter_content(chunk_size=cfg.DOWNLOAD_CHUNCK_SIZE):
             if chunk:
                 ds_file.write(chunk)
                 downloaded += len(chunk)
-                print(
-                    _get_progress_log(downloaded, data_length) + size_mb_msg,
-                    end="\r",
-                    flush=True,
-                )
+                if show_progress:
+                    print(
+                        _get_progress_log(downloaded, data_length) + size_mb_msg,
+                        end="\r",
+                        flush=True,
+                    )
+
+    if data_length != -1 and downloaded != data_length:
+        raise RuntimeError(
+            f"Incomplete download of {url} ({downloaded} of {data_length} bytes). "
+            "Run again to resume it."
+        )
+    part_path.replace(dataset_file_path)
     return dataset_file_path
 
 
+def _download_manifest_path(dataset_name: str) -> Path:
+    return _get_path(cfg.DS_DIR, dataset_name) / "download_manifest.json"
+
+
+def _get_download_entry(dataset_name: str, file_name: str) -> Optional[dict]:
+    with _DOWNLOAD_MANIFEST_LOCK:
+        manifest = load_manifest(_download_manifest_path(dataset_name)) or {}
+    return manifest.get(file_name)
+
+
+def _record_partial(dataset_name: str, part_name: str, headers: Mapping[str, str]):
+    """Stores the validators of the response a partial download comes from."""
+    manifest_path = _download_manifest_path(dataset_name)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    with _DOWNLOAD_MANIFEST_LOCK:
+        manifest = load_manifest(manifest_path) or {}
+        manifest[part_name] = {
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+        }
+        save_manifest(manifest_path, manifest)
+
+
+def _record_download(
+    dataset_name: str, url: str, dataset_file_path: Path, headers: Mapping[str, str]
+):
+    """Stores the validators and checksum of a downloaded file."""
+    stat = dataset_file_path.stat()
+    entry = {
+        "url": url,
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": file_sha256(dataset_file_path),
+    }
+    manifest_path = _download_manifest_path(dataset_name)
+    with _DOWNLOAD_MANIFEST_LOCK:
+        manifest = load_manifest(manifest_path) or {}
+        manifest[dataset_file_path.name] = entry
+        manifest.pop(_part_path(dataset_file_path).name, None)
+        save_manifest(manifest_path, manifest)
+
+
+def _local_file_matches(dataset_file_path: Path, entry: Optional[dict]) -> bool:
+    """Checks if a downloaded file is still the one recorded in the manifest."""
+    if entry is None:
+        return False
+    stat = dataset_file_path.stat()
+    if stat.st_size != entry["size"]:
+        return False
+    if stat.st_mtime_ns == entry["mtime_ns"]:
+        return True
+    return file_sha256(dataset_file_path) == entry["sha256"]
+
+
+def _not_modified(response: Response, entry: dict) -> bool:
+    """
+    Checks if the response to a conditional request is for the file recorded
+    in the manifest (without reading its body).
+    """
+    if response.status_code == 304:
+        return True
+    etag = response.headers.get("ETag")
+    if entry["etag"] and etag:
+        return etag == entry["etag"]
+    # Some hosts ignore If-Modified-Since and send no ETag
+    length = response.headers.get("Content-Length")
+    return (
+        entry["last_modified"] is not None
+        and response.headers.get("Last-Modified") == entry["last_modified"]
+        and length is not None
+        and int(length) == entry["size"]
+    )
+
+
+def _apply_download_policy(msg: str, response: Optional[Response] = None) -> bool:
+    """
+    Decides what to do with a local file that may differ from the remote one.
+    Returns True if it must be downloaded again.
+    """
+    policy = cfg.DOWNLOAD_POLICY
+    if policy == DOWNLOAD_POLICY_OVERWRITE:
+        logging.warning("%s\nOverwriting it", msg)
+        return True
+
+    if response is not None:
+        response.close()
+    if policy == DOWNLOAD_POLICY_KEEP:
+        logging.warning("%s\nKeeping the local file", msg)
+        return False
+    if policy == DOWNLOAD_POLICY_FAIL:
+        raise RuntimeError(msg)
+    raise ValueError(f"Unknown download policy: '{policy}'")
+
+
 def _download(
-    url: str, dataset_name: str, dataset_path: Path, check_size: bool = True
+    url: str,
+    dataset_name: str,
+    dataset_path: Path,
+    check_size: bool = True,
+    show_progress: bool = True,
 ) -> Path:
-    # Make the download request
-    response = _start_download(url, dataset_name)
-
     # Check if the dataset is already downloaded
     dataset_file_path = dataset_path / url.split("/")[-1]
-    if dataset_file_path.exists():
-        if not check_size:
+    if not dataset_file_path.exists():
+        response = _resume_download(url, dataset_name, dataset_file_path)
+        dataset_file_path = _download_until_finish(
+            url, dataset_name, response, dataset_path, show_progress
+        )
+        _record_download(dataset_name, url, dataset_file_path, response.headers)
+        return dataset_file_path
+
+    if not check_size:
+        return dataset_file_path
+
+    entry = _get_download_entry(dataset_name, dataset_file_path.name)
+    local_ok = _local_file_matches(dataset_file_path, entry)
+
+    # The remote file has validators: ask for it only if it changed
+    if local_ok and (entry["etag"] or entry["last_modified"]):
+        cond_headers = {}
+        if entry["etag"]:
+            cond_headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            cond_headers["If-Modified-Since"] = entry["last_modified"]
+        response = _start_download(url, dataset_name, headers=cond_headers)
+        if _not_modified(response, entry):
+            logging.info("Dataset already downloaded (not modified)")
+            response.close()
             return dataset_file_path
-        size = -1
-        if "content-length" in response.headers:
-            size = int(response.headers["content-length"])
-            if size == dataset_file_path.stat().st_size:
-                logging.info("Dataset already downloaded")
-                return dataset_file_path
 
-        msg = (
-            "There is a downloaded dataset with the same name, but the download "
-            "size is unknown."
+        msg = "The remote dataset has changed since it was downloaded."
+        if not _apply_download_policy(msg, response):
+            return dataset_file_path
+        dataset_file_path = _download_until_finish(
+            url, dataset_name, response, dataset_path, show_progress
         )
+        _record_download(dataset_name, url, dataset_file_path, response.headers)
+        return dataset_file_path
 
-        if size != -1:
-            msg = (
-                "It seems that the dataset is already downloaded, but the size is "
-                f"different.\n"
-                f"    Found: {dataset_file_path.stat().st_size / 1024 ** 2:.2f} MB\n"
-                f"    Expected: {size / 1024 ** 2:.2f} MB\n"
-            )
-        logging.warning(msg)
-        ans = input("Do you want to overwrite it? [y/n]: ")
-        if ans.lower() != "y":
-            return dataset_file_path
+    # Otherwise, compare the sizes
+    headers = _remote_headers(url)
+    size = int(headers.get("Content-Length", -1))
+    local_size = dataset_file_path.stat().st_size
+    if size == local_size or (size == -1 and local_ok):
+        logging.info("Dataset already downloaded")
+        if not local_ok:
+            _record_download(dataset_name, url, dataset_file_path, headers)
+        return dataset_file_path
+
+    msg = (
+        "There is a downloaded dataset with the same name, but the download "
+        "size is unknown."
+    )
+
+    if size != -1:
+        msg = (
+            "It seems that the dataset is already downloaded, but the size is "
+            f"different.\n"
+            f"    Found: {local_size / 1024 ** 2:.2f} MB\n"
+            f"    Expected: {size / 1024 ** 2:.2f} MB"
+        )
+    if not _apply_download_policy(msg):
+        return dataset_file_path
 
     # Download the dataset to a zip file
-    return _download_until_finish(url, response, dataset_path)
+    response = _start_download(url, dataset_name)
+    dataset_file_path = _download_until_finish(
+        url, dataset_name, response, dataset_path, show_progress
+    )
+    _record_download(dataset_name, url, dataset_file_path, response.headers)
+    return dataset_file_path
+
+
+def _extract(dataset_file_path: Path, dataset_name: str, dataset_path: Path):
+    if is_archive(dataset_file_path):
+        # Read in place by the recipes (see utils.rawfs)
+        return
+    logging.info("Extracting %s dataset", dataset_name)
+    patoolib.extract_archive(
+        str(dataset_file_path),
+        outdir=str(dataset_path),
+        verbosity=1,
+        interactive=False,
+    )
 
 
 def download_dataset(
     url: str, dataset_name: str, uncompress: bool = True, check_size: bool = True
 ) -> Path:
-    """Downloads a dataset from a url."""
+    """
+    Downloads a dataset from a url.
+
+    If ``uncompress`` is True, the downloaded file is extracted unless it is
+    an archive that can be read in place with ``utils.rawfs.open_raw``.
+    """
 
     # Create the dataset folder if it doesn't exist
     dataset_path = _create_dataset_path(dataset_name)
 
     # Download the compressed version of the dataset
-    dataset_file_path = _download(url, dataset_name, dataset_path, check_size)
+    with instrument.stage("download"):
+        dataset_file_path = _download(url, dataset_name, dataset_path, check_size)
 
     # Extract the dataset
     if uncompress:
-        logging.info("Extracting %s dataset", dataset_name)
-        patoolib.extract_archive(
-            str(dataset_file_path),
-            outdir=str(dataset_path),
-            verbosity=1,
-            interactive=False,
-        )
+        with instrument.stage("extract"):
+            _extract(dataset_file_path, dataset_name, dataset_path)
 
     return dataset_file_path
+
+
+def download_datasets(
+    urls: List[str],
+    dataset_name: str,
+    uncompress: bool = True,
+    check_size: bool = True,
+) -> List[Path]:
+    """
+    Downloads several files of a dataset concurrently.
+
+    Returns the downloaded file paths in the same order as ``urls``.
+    """
+
+    # Create the dataset folder if it doesn't exist
+    dataset_path = _create_dataset_path(dataset_name)
+
+    # Progress bars of concurrent downloads would overlap, so they are hidden
+    show_progress = len(urls) == 1
+    max_workers = max(1, min(cfg.DOWNLOAD_MAX_WORKERS, len(urls)))
+    with instrument.stage("download"), ThreadPoolExecutor(max_workers) as executor:
+        futures = [
+            executor.submit(
+                _download, url, dataset_name, dataset_path, check_size, show_progress
+            )
+            for url in urls
+        ]
+        dataset_file_paths = [future.result() for future in futures]
+
+    # Extract the dataset files
+    if uncompress:
+        with instrument.stage("extract"):
+            for dataset_file_path in dataset_file_paths:
+                _extract(dataset_file_path, dataset_name, dataset_path)
+
+    return dataset_file_paths